@@ -1,14 +1,15 @@
 import os
 import json
+import asyncio
 import logging
 import traceback
-import psycopg2
 from datetime import datetime, timedelta
 import pytz
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, Update
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiohttp import web
@@ -18,6 +19,20 @@ from notion_client import Client
 
 # Импортируем твой обновленный мозг
 from src.brain import AssistantBrain
+from src.storage import Database, ChatStorage
+from src.fsm_storage import PostgresFSMStorage, FSMFlushMiddleware, FSM_CACHE_TTL
+from src.sheets import SheetSink, SHEET_INDEX_RECONCILE_MINUTES
+from src.reminders import ReminderScheduler, ReminderStage
+from src.pipeline import LeadPipeline
+from src.outbox import Outbox
+from src.summarizer import ConversationSummarizer
+from src.turn_gate import UserTurnGate
+from src.update_queue import UpdateQueue, update_key
+from src.leader import LeaderElection, MULTI_INSTANCE
+from src.broadcast import Broadcaster, SENT
+from src.analytics import FunnelStats, FunnelMiddleware, format_summary
+from src.metrics import (observe, timed, set_queue_depths, render, EventLoopMonitor,
+                         WEBHOOK_SECONDS, WEBHOOK_ERRORS, FEED_UPDATE_SECONDS, FEED_UPDATE_ERRORS)
 
 # ================== КОНФИГУРАЦИЯ ==================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -27,6 +42,15 @@ ADMIN_ZHENA_ID = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
 ADMIN_MUZH_ID = int(os.getenv("ADMIN_MUZH_ID", "0"))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", "10000"))
+# Ответ ИИ в Телеграм печатается по мере генерации (правкой одного сообщения)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# inline — вебхук ждет обработки апдейта; queue — сразу отвечает 200, апдейты обрабатываются по очереди чата
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "inline")
+STATS_TOKEN = os.getenv("STATS_TOKEN")  # доступ к /stats/funnel для маркетинга
+REMINDER_RELOAD_MINUTES = int(os.getenv("REMINDER_RELOAD_MINUTES", "1"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "0.7"))  # не чаще одной правки за N секунд
+STREAM_FINAL_EDIT_RETRIES = 3  # финальную правку при flood control повторяем после паузы
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 NOTION_DATABASE_ID = "308a163edd1580caa995ecbefbfe7ee4"
@@ -37,10 +61,20 @@ logging.basicConfig(level=logging.INFO)
 # ================== ИНИЦИАЛИЗАЦИЯ ==================
 brain = AssistantBrain()
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# Пул соединений Postgres поднимается в on_startup, запросы не блокируют event loop
+db = Database(DATABASE_URL)
+# Анкеты (FSM) хранятся в Postgres: переживают деплой и видны всем экземплярам.
+# При нескольких экземплярах апдейты чата попадают на разные — копии анкеты в памяти не доверяем
+fsm_storage = PostgresFSMStorage(db, ttl=0 if MULTI_INSTANCE else FSM_CACHE_TTL)
+dp = Dispatcher(storage=fsm_storage)
+dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
+# Воронка анкеты: каждый переход по шагам BookingForm — в Postgres со счетчиками по дням и кампаниям
+funnel = FunnelStats(db)
+dp.update.outer_middleware(FunnelMiddleware(funnel))
 scheduler = AsyncIOScheduler(timezone="Europe/Sofia")
 
 # Инициализация Google/Notion (оставляем твой код без изменений)
+main_sheet = unconfirmed_sheet = notion = None
 try:
     service_account_info = json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"])
     credentials = Credentials.from_service_account_info(service_account_info, scopes=["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"])
@@ -52,38 +86,19 @@ try:
 except Exception as e:
     logging.error(f"Критическая ошибка инициализации API: {e}")
 
+# Запись в таблицы идет через очередь: хендлеры не ждут ответа Google
+sheet_sink = SheetSink(main_sheet, unconfirmed_sheet)
+# Массовые сообщения (дожатие) — в пределах лимитов Телеграма
+broadcaster = Broadcaster(bot)
+
 # ================== РАБОТА С POSTGRES (ПАМЯТЬ ИИ) ==================
-def init_db():
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    cur.execute('''CREATE TABLE IF NOT EXISTS chat_history 
-                   (user_id TEXT PRIMARY KEY, history JSONB)''')
-    conn.commit()
-    cur.close()
-    conn.close()
-
-init_db()
-
-def get_history(user_id):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT history FROM chat_history WHERE user_id = %s", (user_id,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        return row[0] if row else []
-    except: return []
-
-def save_history(user_id, history):
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO chat_history (user_id, history) VALUES (%s, %s) "
-                "ON CONFLICT (user_id) DO UPDATE SET history = EXCLUDED.history",
-                (user_id, json.dumps(history)))
-    conn.commit()
-    cur.close()
-    conn.close()
+# С несколькими экземплярами счетчик вопросов не кэшируется: другой экземпляр мог дописать историю
+chat_storage = ChatStorage(db, cache_counts=not MULTI_INSTANCE)
+# Длинные истории сворачиваются в сводку фоновым воркером
+summarizer = ConversationSummarizer(chat_storage, brain.client_ai)
+ANONYMOUS_WEB_USER = "web_anonymous"  # посетители сайта без user_id
+# Ходы ИИ по одному на пользователя, сообщения подряд склеиваются
+turn_gate = UserTurnGate(shared_keys=(ANONYMOUS_WEB_USER,))
 
 # ================== ХЕНДЛЕРЫ ВОРОНКИ (ТВОИ СТАРЫЕ) ==================
 
@@ -104,12 +119,13 @@ confirm_keyboard = InlineKeyboardMarkup(
     inline_keyboard=[[InlineKeyboardButton(text="📅 Подтвердить данные", callback_data="confirm_final")]])
 
 
-async def send_and_update_status(tid, msg, row_idx, col_idx, status_code):
-    try:
-        await bot.send_message(tid, msg)
-        unconfirmed_sheet.update_cell(row_idx, col_idx, status_code)
-    except Exception as e:
-        logging.error(f"Ошибка отправки дожатия {status_code} для {tid}: {e}")
+async def send_and_update_status(messages: list, col_idx):
+    """messages — [(tid, текст, статус)]: рассылка с лимитами, статусы отправленных — одной записью в таблицу"""
+    results = await broadcaster.send_many([(tid, msg) for tid, msg, _ in messages])
+    sent = [(tid, col_idx, status_code) for (tid, _, status_code), result in zip(messages, results)
+            if result == SENT]
+    if sent:
+        sheet_sink.update_statuses(sent)
 
 
 def sync_unconfirmed(data: dict, status: str):
@@ -140,23 +156,8 @@ def sync_unconfirmed(data: dict, status: str):
             status
         ]
 
-        # 1. Ищем ID пользователя ТОЛЬКО в первом столбце (Column A)
-        col_a_values = unconfirmed_sheet.col_values(1)
-
-        try:
-            # Находим индекс (list.index вернет первое совпадение)
-            # +1 потому что в Python индексы с 0, а в Таблицах с 1
-            row_index = col_a_values.index(tid) + 1
-            # ОБНОВЛЯЕМ существующую строку
-            unconfirmed_sheet.update(range_name=f"A{row_index}:O{row_index}", values=[row])
-            logging.info(f"Обновлена строка {row_index} для ID {tid}")
-
-        except ValueError:
-            # 2. Если ID не найден — ДОБАВЛЯЕМ новую строку в самый конец
-            # Используем insert_row в len+1, это надежнее чем append_row
-            next_free_row = len(col_a_values) + 1
-            unconfirmed_sheet.insert_row(row, index=next_free_row)
-            logging.info(f"Создана новая строка {next_free_row} для ID {tid}")
+        # Строку найдет и обновит (или добавит) фоновый воркер SheetSink
+        return sheet_sink.upsert_unconfirmed(tid, row)
 
     except Exception as e:
         logging.error(f"Критическая ошибка Google Sheets: {e}")
@@ -165,7 +166,8 @@ def finalize_to_main(data: dict):
     try:
         target = data.get("target", "w")
         tid = str(data.get("telegram_id", ""))
-        current_time = datetime.now(pytz.timezone('Europe/Sofia')).strftime("%d.%m.%Y %H:%M:%S")
+        # Время подтверждения фиксируется в хендлере: при повторе из outbox оно не должно меняться
+        current_time = data.get("confirmed_at") or datetime.now(pytz.timezone('Europe/Sofia')).strftime("%d.%m.%Y %H:%M:%S")
 
         row_main = [
             tid, data.get("username", ""), target, data.get("source", ""), data.get("campaign", ""),
@@ -175,11 +177,9 @@ def finalize_to_main(data: dict):
             data.get("time_of_day", ""), data.get("email", ""), current_time
         ]
 
-        main_sheet.append_row(row_main, value_input_option="USER_ENTERED")
-        cell = unconfirmed_sheet.find(tid, in_column=1)
-        if cell:
-            unconfirmed_sheet.delete_rows(cell.row)
-        return True
+        # Перенос в leads_main и удаление из leads_unconfirmed — одной операцией очереди.
+        # Возвращает future, который станет True/False после записи пачки
+        return sheet_sink.finalize(tid, row_main)
     except Exception:
         traceback.print_exc()
         return False
@@ -188,57 +188,161 @@ def finalize_to_main(data: dict):
 def send_to_notion(data: dict):
     try:
         username = data.get("username", "скрыт")
-        notion.pages.create(
-            parent={"database_id": NOTION_DATABASE_ID},
-            properties={
-                "Name": {"title": [{"text": {"content": data.get("name", "N/A")}}]},
-                "Telegram": {"rich_text": [{"text": {"content": f"@{username}"}}]},
-                "Role": {"rich_text": [{"text": {"content": data.get("role", "N/A")}}]},
-                "Status": {"status": {"name": "New Lead"}}
-            }
-        )
+        with observe("notion", "pages.create"):
+            notion.pages.create(
+                parent={"database_id": NOTION_DATABASE_ID},
+                properties={
+                    "Name": {"title": [{"text": {"content": data.get("name", "N/A")}}]},
+                    "Telegram": {"rich_text": [{"text": {"content": f"@{username}"}}]},
+                    "Role": {"rich_text": [{"text": {"content": data.get("role", "N/A")}}]},
+                    "Status": {"status": {"name": "New Lead"}}
+                }
+            )
         return True
     except Exception as e:
         logging.error(f"Notion Error: {e}")
         return False
 
 
+# ================== ФИНАЛИЗАЦИЯ ЛИДА (OUTBOX) ==================
+
+async def sheets_upsert_sink(data: dict):
+    future = sync_unconfirmed(data, data.get("status", ""))
+    return bool(future) and await future
+
+
+async def sheets_sink(data: dict):
+    future = finalize_to_main(data)
+    return bool(future) and await future
+
+
+async def notion_sink(data: dict):
+    return await lead_pipeline.run_blocking(send_to_notion, data)
+
+
+async def admin_sink(data: dict):
+    # Уведомление админа
+    admin_id = ADMIN_MUZH_ID if data.get("target") in ["m", "cm"] else ADMIN_ZHENA_ID
+    await bot.send_message(admin_id, f"Новый лид: {data.get('name')} (@{data.get('username')})")
+    return True
+
+
+lead_pipeline = LeadPipeline()
+lead_pipeline.add_sink("sheets_upsert", sheets_upsert_sink, retries=1)
+# SheetSink сам повторяет запросы к Google, повтор всей операции задублировал бы строку в leads_main
+lead_pipeline.add_sink("sheets", sheets_sink, retries=1)
+lead_pipeline.add_sink("notion", notion_sink)
+lead_pipeline.add_sink("admin", admin_sink)
+
+# Хендлеры пишут намерения в Postgres, диспетчер доставляет их в интеграции пачками
+outbox = Outbox(db, lead_pipeline)
+
+
+# Интеграции, события которых для одного лида нужно доставлять строго по порядку
+SINK_ORDERING = {"sheets_upsert": "sheets", "sheets": "sheets"}
+
+
+def lead_event(data: dict, event: str, sink: str, **extra):
+    """
+    Запись для outbox. Ключ идемпотентности: telegram_id + событие + время начала анкеты.
+    Ключ очереди: telegram_id + семейство интеграции — Notion и админ не ждут повторов таблиц.
+    """
+    key = f"{data.get('telegram_id')}:{event}:{data.get('created_at', '')}:{sink}"
+    ordering_key = f"{data.get('telegram_id')}:{SINK_ORDERING.get(sink, sink)}"
+    return key, sink, {**data, **extra}, ordering_key
+
+
 # ================== ДОЖАТИЕ (SCHEDULER) ==================
 
-async def check_abandoned_carts():
+REMINDER_MESSAGES = {
+    "notified_n1": "🎁 Почти готово! Завершите опрос и заберите подарок.",
+    "notified_n2": "Мы всё еще сохраняем за вами возможность попасть на диагностику. Актуально?",
+}
+REMINDER_STAGES = [
+    ReminderStage("notified_n1", delay=timedelta(minutes=15), expire_after=timedelta(hours=1)),
+    ReminderStage("notified_n2", delay=timedelta(days=3), expire_after=timedelta(days=4)),
+]
+
+
+async def send_reminders(batch):
+    await send_and_update_status([(tid, REMINDER_MESSAGES[code], code) for tid, code in batch], 15)
+
+
+# Касания ставятся в cmd_start и снимаются в confirm_final, таблицу целиком больше не читаем
+reminders = ReminderScheduler(db, REMINDER_STAGES, send_reminders)
+
+
+async def import_reminders_from_sheet():
+    """
+    Разовый перенос незавершенных анкет из leads_unconfirmed в reminders.
+    После переноса ставится отметка в reminder_imports, и таблица больше не читается.
+    Если reminders уже не пустая, перенос сделала прошлая версия — только ставим отметку.
+    """
+    if await reminders.is_imported("leads_unconfirmed"):
+        return
+    if not await reminders.is_empty():
+        await reminders.mark_imported("leads_unconfirmed")
+        return
+    loop = asyncio.get_running_loop()
+    records = await loop.run_in_executor(None, timed("gspread", "get_all_records")(unconfirmed_sheet.get_all_records))
+    tz = pytz.timezone('Europe/Sofia')
+    imported = 0
+    for row in records:
+        tid = row.get('telegram_id')
+        created_val = row.get('created_at')
+        if not tid or not created_val:
+            continue
+        try:
+            start_dt = tz.localize(datetime.strptime(str(created_val), "%d.%m.%Y %H:%M:%S"))
+        except ValueError:
+            continue
+        current_status = str(row.get('status', ''))
+        done = [stage.code for stage in REMINDER_STAGES if stage.code in current_status]
+        await reminders.schedule(tid, start_dt, skip_stages=done)
+        imported += 1
+    await reminders.mark_imported("leads_unconfirmed", imported)
+    logging.info(f"Дожатие: перенесено {imported} анкет из leads_unconfirmed")
+
+
+# Сверяем локальный индекс строк leads_unconfirmed с таблицей (на случай ручных правок)
+scheduler.add_job(sheet_sink.reconcile, "interval", minutes=SHEET_INDEX_RECONCILE_MINUTES)
+scheduler.add_job(outbox.purge, "interval", hours=24)
+# Касания, поставленные другими экземплярами, лидер подхватывает из таблицы.
+# Один экземпляр ставит и снимает касания сам, ему перечитывать таблицу незачем
+if MULTI_INSTANCE:
+    scheduler.add_job(reminders.load, "interval", minutes=REMINDER_RELOAD_MINUTES)
+
+
+# ================== ФОНОВЫЕ ЗАДАЧИ (ТОЛЬКО У ЛИДЕРА) ==================
+# Вебхук и сайт обслуживает каждый экземпляр; дожатие, outbox (а через него и запись в таблицы)
+# и задачи по расписанию — только лидер, чтобы ничего не ушло дважды
+
+async def start_background_jobs():
     try:
-        records = unconfirmed_sheet.get_all_records()
-        if not records: return
-        tz = pytz.timezone('Europe/Sofia')
-        now = datetime.now(tz).replace(tzinfo=None)
-
-        for i, row in enumerate(records):
-            tid = row.get('telegram_id')
-            created_val = row.get('created_at')
-            current_status = str(row.get('status', ''))
-            target = str(row.get('target', '')).lower()
-            if not tid or not created_val: continue
-
-            try:
-                start_dt = datetime.strptime(str(created_val), "%d.%m.%Y %H:%M:%S")
-            except:
-                continue
-
-            diff = now - start_dt
-            row_idx = i + 2
-            is_cd = "cd" in target
-
-            if timedelta(minutes=15) <= diff < timedelta(hours=1) and "notified_n1" not in current_status:
-                msg = "🎁 Почти готово! Завершите опрос и заберите подарок."
-                await send_and_update_status(tid, msg, row_idx, 15, "notified_n1")
-            elif timedelta(days=3) <= diff < timedelta(days=4) and "notified_n2" not in current_status:
-                msg = "Мы всё еще сохраняем за вами возможность попасть на диагностику. Актуально?"
-                await send_and_update_status(tid, msg, row_idx, 15, "notified_n2")
+        await import_reminders_from_sheet()
     except Exception as e:
         logging.error(f"Scheduler error: {e}")
+    await reminders.load()
+    reminders.start()
+    sheet_sink.start()
+    outbox.start()
+    if scheduler.running:
+        scheduler.resume()
+    else:
+        scheduler.start()
+
+
+async def stop_background_jobs():
+    if scheduler.running:
+        scheduler.pause()
+    await reminders.close()
+    # Диспетчер доставляет и отмечает текущую пачку, новых не берет
+    await outbox.close()
+    # Дописываем в таблицы всё, что еще в очереди
+    await sheet_sink.close()
 
 
-scheduler.add_job(check_abandoned_carts, "interval", minutes=15)
+leader = LeaderElection(DATABASE_URL, start_background_jobs, stop_background_jobs)
 
 
 # ================== API ЭНДПОИНТЫ ==================
@@ -274,7 +378,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
     parts = param.split("_")
     target = parts[0] if parts[0] in ["w", "m", "cd", "cw", "cm"] else "w"
     tz = pytz.timezone('Europe/Sofia')
-    now_str = datetime.now(tz).strftime("%d.%m.%Y %H:%M:%S")
+    now = datetime.now(tz)
+    now_str = now.strftime("%d.%m.%Y %H:%M:%S")
 
     data = {
         "telegram_id": message.from_user.id,
@@ -285,7 +390,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
         "name": "", "email": "", "created_at": now_str
     }
     await state.update_data(**data)
-    sync_unconfirmed(data, now_str)
+    await outbox.write([lead_event(data, "start", "sheets_upsert", status=now_str)])
+    await reminders.schedule(message.from_user.id, now)
 
     msg = "Здравствуйте! Как к вам можно обращаться?"
     await message.answer(msg, reply_markup=ReplyKeyboardRemove())
@@ -355,8 +461,17 @@ async def proc_email(message: types.Message, state: FSMContext):
 @dp.callback_query(F.data == "confirm_final")
 async def confirm_final(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    finalize_to_main(data)
-    send_to_notion(data)
+    if not data.get("telegram_id"):
+        # Повторное нажатие после state.clear(): анкета уже подтверждена, данных нет
+        await callback.answer("Данные уже приняты")
+        return
+    data["confirmed_at"] = datetime.now(pytz.timezone('Europe/Sofia')).strftime("%d.%m.%Y %H:%M:%S")
+
+    # Сначала надежно фиксируем намерения (таблица, Notion, админ) — одной транзакцией.
+    # Недоставленная строка leads_unconfirmed больше не нужна: иначе ее повтор вернул бы лид в неподтвержденные
+    await outbox.write([lead_event(data, "confirm", sink) for sink in ("sheets", "notion", "admin")],
+                       supersedes=("sheets_upsert",))
+    await funnel.record("confirmed", data)
 
     if data.get("target") == "cd":
         # Берем значения безопасно, чтобы не вылетало ошибок, если ключа нет
@@ -373,12 +488,20 @@ async def confirm_final(callback: types.CallbackQuery, state: FSMContext):
     else:
         await callback.message.edit_text("✅ Данные приняты! Мы свяжемся с вами.")
 
-    # Уведомление админа
-    admin_id = ADMIN_MUZH_ID if data.get("target") in ["m", "cm"] else ADMIN_ZHENA_ID
-    await bot.send_message(admin_id, f"Новый лид: {data['name']} (@{data.get('username')})")
+    await reminders.cancel(data.get("telegram_id", callback.from_user.id))
     await state.clear()
 
 
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message, command: CommandObject):
+    """Воронка для админов: /stats или /stats 30 (дней)"""
+    if message.from_user.id not in (ADMIN_ZHENA_ID, ADMIN_MUZH_ID):
+        return
+    days = int(command.args) if command.args and command.args.strip().isdigit() else 7
+    summary = await funnel.summary(max(1, min(days, 365)))
+    await message.answer(format_summary(summary))
+
+
 # --- ФИНАЛЬНЫЙ ХЕНДЛЕР ДЛЯ ИИ ---
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
@@ -387,7 +510,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     # 2. ОЧИЩАЕМ ПАМЯТЬ ИИ в Postgres (чтобы Александр начал с чистого листа)
     user_id = f"tg_{message.from_user.id}"
-    save_history(user_id, [])
+    await chat_storage.clear_history(user_id)
 
     # 3. Разбираем параметры старта
     args = message.text.split()
@@ -416,7 +539,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     # Время для таблицы (Болгария)
     tz = pytz.timezone('Europe/Sofia')
-    now_str = datetime.now(tz).strftime("%d.%m.%Y %H:%M:%S")
+    now = datetime.now(tz)
+    now_str = now.strftime("%d.%m.%Y %H:%M:%S")
 
     # Собираем данные
     data = {
@@ -432,8 +556,9 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     # 4. Сохраняем данные и синхронизируем с Google Таблицей
     await state.update_data(**data)
-    # Используем обновленную функцию sync_unconfirmed (которая не затирает строки)
-    sync_unconfirmed(data, "Не подтверждено")
+    # Строку в leads_unconfirmed запишет диспетчер outbox через sync_unconfirmed
+    await outbox.write([lead_event(data, "start", "sheets_upsert", status="Не подтверждено")])
+    await reminders.schedule(message.from_user.id, now)
 
     # 5. Выдаем приветственный текст в зависимости от цели (target)
     # Используем startswith('c'), так как 'cd', 'cw', 'cm' — это всё исследовательские ветки
@@ -469,24 +594,92 @@ async def main_handler(message: types.Message, state: FSMContext):
     # 1. Если пользователь в процессе опроса — игнорируем, aiogram сам найдет нужный хендлер
     if current_state is not None:
         return
+    # Фото, стикеры и прочее без текста ИИ не отвечает
+    if not message.text:
+        return
 
     # 2. Достаем имя из анкеты, если оно там есть
     user_data = await state.get_data()
     user_name = user_data.get("name") # Имя, которое мы сохранили в BookingForm.name
 
     user_id = f"tg_{message.from_user.id}"
-    history = get_history(user_id)
 
-    # ПЕРЕДАЕМ ИМЯ в мозг Александра
-    answer = await brain.get_answer(message.text, history, user_name=user_name)
+    # 3. Несколько сообщений подряд — один ход ИИ; отвечаем на последнее
+    text = await turn_gate.collect(user_id, message.text,
+                                   has_more=lambda: update_queue.backlog(message.chat.id) > 0)
+    if text is None:
+        return
 
-    # Сохраняем историю
-    new_history = history + [
-        {"role": "user", "content": message.text},
-        {"role": "assistant", "content": answer}
-    ]
-    save_history(user_id, new_history)
-    await message.answer(answer)
+    async with turn_gate.lock(user_id):
+        history = await chat_storage.get_history(user_id)
+        summary = await chat_storage.get_summary(user_id)
+        questions_count = await chat_storage.count_questions(user_id)
+
+        # ПЕРЕДАЕМ ИМЯ в мозг Александра
+        if STREAM_REPLIES:
+            chunks = brain.stream_answer(text, history, user_name=user_name,
+                                         questions_count=questions_count, summary=summary)
+            answer = await stream_reply(message, chunks)
+        else:
+            answer = await brain.get_answer(text, history, user_name=user_name,
+                                            questions_count=questions_count, summary=summary)
+            await message.answer(answer)
+
+        # Дописываем в историю только новый ход
+        await chat_storage.append_messages(user_id, [
+            {"role": "user", "content": text},
+            {"role": "assistant", "content": answer}
+        ])
+    summarizer.notify(user_id)
+
+
+async def edit_streamed(sent: types.Message, text: str, final: bool = False):
+    """
+    Правка сообщения со стримом. Возвращает, сколько секунд Телеграм просит не править (0 — можно).
+    Промежуточную правку при flood control пропускаем; финальную повторяем после паузы,
+    иначе у пользователя останется обрезанный ответ.
+    """
+    for _ in range(STREAM_FINAL_EDIT_RETRIES if final else 1):
+        try:
+            await sent.edit_text(text[:TELEGRAM_MESSAGE_LIMIT])
+            return 0
+        except TelegramRetryAfter as e:
+            logging.warning(f"Telegram flood control при стриминге: {e.retry_after} c")
+            if not final:
+                return e.retry_after
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.error(f"Ошибка правки сообщения: {e}")
+            return 0
+    logging.error("Финальная правка ответа не прошла после повторов")
+    return 0
+
+
+async def stream_reply(message: types.Message, chunks):
+    """Сразу шлем заглушку, потом правим ее по мере генерации. Возвращает полный текст ответа"""
+    loop = asyncio.get_running_loop()
+    sent = await message.answer("✍️ ...")
+    text, shown = "", ""
+    next_edit = loop.time() + STREAM_EDIT_INTERVAL
+
+    async for delta in chunks:
+        text += delta
+        if loop.time() >= next_edit and text.strip() and text != shown:
+            pause = await edit_streamed(sent, text)
+            if not pause:
+                shown = text
+            # После flood control не правим, пока Телеграм не разрешит
+            next_edit = loop.time() + max(STREAM_EDIT_INTERVAL, pause)
+
+    # Финальная правка (и хвост отдельными сообщениями, если ответ длиннее лимита Телеграма)
+    if text != shown:
+        if loop.time() < next_edit:
+            await asyncio.sleep(next_edit - loop.time())
+        await edit_streamed(sent, text or "…", final=True)
+    for start in range(TELEGRAM_MESSAGE_LIMIT, len(text), TELEGRAM_MESSAGE_LIMIT):
+        await message.answer(text[start:start + TELEGRAM_MESSAGE_LIMIT])
+    return text
 
 # ================== API ДЛЯ САЙТА (ТИЛЬДА) ==================
 
@@ -505,7 +698,7 @@ async def handle_ask_website(request):
         question = data.get("question", "").strip()
 
         # 1. Проверяем историю
-        history = get_history(user_id)
+        history = await chat_storage.get_history(user_id)
 
         # 2. Если это ПЕРВОЕ сообщение от пользователя
         if not history:
@@ -515,16 +708,21 @@ async def handle_ask_website(request):
                 "Как к вам можно обращаться?"
             )
             # Сохраняем "виртуальное" приветствие в историю, чтобы в следующий раз ИИ знал имя
-            save_history(user_id, [{"role": "assistant", "content": welcome_text}])
+            await chat_storage.append_messages(user_id, [{"role": "assistant", "content": welcome_text}])
             return web.json_response({"answer": welcome_text}, headers=headers)
 
         # 3. Если история уже есть, работаем через AssistantBrain
-        answer = await brain.get_answer(question, history)
+        summary = await chat_storage.get_summary(user_id)
+        questions_count = await chat_storage.count_questions(user_id)
+        answer = await brain.get_answer(question, history, questions_count=questions_count,
+                                        use_cache=True, summary=summary)
 
         # Обновляем историю
-        history.append({"role": "user", "content": question})
-        history.append({"role": "assistant", "content": answer})
-        save_history(user_id, history)
+        await chat_storage.append_messages(user_id, [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer}
+        ])
+        summarizer.notify(user_id)
 
         return web.json_response({"answer": answer}, headers=headers)
 
@@ -533,89 +731,284 @@ async def handle_ask_website(request):
         return web.json_response({"error": "Ошибка связи"}, status=500, headers=headers)
 
 # ================== ЗАПУСК СЕРВЕРА ==================
+async def process_update(update: Update):
+    with FEED_UPDATE_SECONDS.time(), FEED_UPDATE_ERRORS.count_exceptions():
+        await dp.feed_update(bot, update)
+
+
+# Очередь апдейтов для WEBHOOK_MODE=queue (в режиме inline пустая)
+update_queue = UpdateQueue(process_update)
+
+
 async def handle_webhook(request):
     """Принимает сообщения из Telegram"""
-    try:
-        body = await request.json()
-        update = Update.model_validate(body)
-        await dp.feed_update(bot, update)
-        return web.Response(text="ok")
-    except Exception as e:
-        logging.error(f"Ошибка в handle_webhook: {e}")
-        return web.Response(text="error", status=500)
+    with WEBHOOK_SECONDS.labels(WEBHOOK_MODE).time():
+        try:
+            body = await request.json()
+            update = Update.model_validate(body)
+            if WEBHOOK_MODE == "queue":
+                if not update_queue.submit(update_key(update), update):
+                    # Очередь полна — Телеграм повторит доставку позже
+                    return web.Response(text="busy", status=503)
+                return web.Response(text="ok")
+            await process_update(update)
+            return web.Response(text="ok")
+        except Exception as e:
+            WEBHOOK_ERRORS.labels(WEBHOOK_MODE).inc()
+            logging.error(f"Ошибка в handle_webhook: {e}")
+            return web.Response(text="error", status=500)
+
+
+# CORS для виджета Тильды
+ASK_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "POST, OPTIONS, GET",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization",
+}
+
+WEBSITE_WELCOME_TEXT = (
+    "Здравствуйте! Рады, что вы заглянули на наш сайт.\n\n"
+    "Я — Александр, ИИ-помощник PRO Unity Consult. Подскажу по программе и диагностике.\n\n"
+    "Как к вам можно обращаться?"
+)
+
+# Убираем разметку Telegram [текст](ссылка), оставляя только чистый текст.
+# Замена посимвольная, поэтому одинаково работает и для целого ответа, и для кусков стрима
+LINK_CLEANUP = str.maketrans({"[": "", "]": "", "(": " ", ")": ""})
 
 
 async def handle_ask_website(request):
-    headers = {
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST, OPTIONS, GET",
-        "Access-Control-Allow-Headers": "Content-Type, Authorization",
-    }
+    headers = ASK_HEADERS
 
     if request.method == "OPTIONS":
         return web.Response(status=200, headers=headers)
 
     try:
         data = await request.json()
-        user_id = data.get("user_id", "web_anonymous")
+        user_id = data.get("user_id", ANONYMOUS_WEB_USER)
         question = data.get("question", "").strip()
 
         if not question:
             return web.json_response({"error": "No question"}, status=400, headers=headers)
 
-        # 1. Получаем историю из БД
-        history = get_history(user_id)
+        async def website_turn(question):
+            async with turn_gate.lock(user_id):
+                # 1. Получаем историю из БД
+                history = await chat_storage.get_history(user_id)
+
+                # 2. ПРИВЕТСТВИЕ ДЛЯ НОВЫХ (если история пуста)
+                if not history:
+                    # Сразу записываем это в базу как первый контакт
+                    await chat_storage.append_messages(user_id, [{"role": "assistant", "content": WEBSITE_WELCOME_TEXT}])
+                    return WEBSITE_WELCOME_TEXT
+
+                # 3. ЛОГИКА ИИ (ограничение и ответ)
+                # Brain сам проверит лимит 5 вопросов, если ты добавил это туда
+                summary = await chat_storage.get_summary(user_id)
+                questions_count = await chat_storage.count_questions(user_id)
+                answer = await brain.get_answer(question, history, questions_count=questions_count,
+                                                use_cache=True, summary=summary)
+
+                # 4. Сохранение истории (дописываем только новые сообщения)
+                await chat_storage.append_messages(user_id, [
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": answer}
+                ])
+            summarizer.notify(user_id)
+
+            # 5. ОЧИСТКА ССЫЛОК (чтобы на сайте не было "роботекста" со скобками)
+            return answer.translate(LINK_CLEANUP)
+
+        # Вопросы, присланные подряд, уходят в ИИ одним ходом — каждый запрос пачки получает его ответ
+        clean_answer = await turn_gate.collect_answer(user_id, question, website_turn)
+        return web.json_response({"answer": clean_answer}, headers=headers)
 
-        # 2. ПРИВЕТСТВИЕ ДЛЯ НОВЫХ (если история пуста)
-        if not history:
-            welcome_text = (
-                "Здравствуйте! Рады, что вы заглянули на наш сайт.\n\n"
-                "Я — Александр, ИИ-помощник PRO Unity Consult. Подскажу по программе и диагностике.\n\n"
-                "Как к вам можно обращаться?"
-            )
-            # Сразу записываем это в базу как первый контакт
-            save_history(user_id, [{"role": "assistant", "content": welcome_text}])
-            return web.json_response({"answer": welcome_text}, headers=headers)
+    except Exception as e:
+        logging.error(f"Error in /ask: {e}")
+        return web.json_response({"error": "Сервер занят, попробуйте позже"}, status=500, headers=headers)
 
-        # 3. ЛОГИКА ИИ (ограничение и ответ)
-        # Brain сам проверит лимит 5 вопросов, если ты добавил это туда
-        answer = await brain.get_answer(question, history)
 
-        # 4. ОЧИСТКА ССЫЛОК (чтобы на сайте не было "роботекста" со скобками)
-        # Убираем разметку Telegram [текст](ссылка), оставляя только чистый текст
-        clean_answer = answer.replace("[", "").replace("]", "").replace("(", " ").replace(")", "")
+async def send_sse(response: web.StreamResponse, payload: dict):
+    await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
 
-        # 5. Сохранение истории (добавляем новые сообщения)
-        new_history = history + [
-            {"role": "user", "content": question},
-            {"role": "assistant", "content": answer}
-        ]
-        save_history(user_id, new_history)
 
-        return web.json_response({"answer": clean_answer}, headers=headers)
+async def handle_ask_stream(request):
+    """/ask в режиме Server-Sent Events: куски ответа уходят на сайт по мере генерации"""
+    headers = ASK_HEADERS
+
+    if request.method == "OPTIONS":
+        return web.Response(status=200, headers=headers)
 
+    try:
+        data = await request.json()
+    except Exception:
+        return web.json_response({"error": "Bad request"}, status=400, headers=headers)
+    user_id = data.get("user_id", ANONYMOUS_WEB_USER)
+    question = data.get("question", "").strip()
+    if not question:
+        return web.json_response({"error": "No question"}, status=400, headers=headers)
+
+    response = web.StreamResponse(headers={
+        **headers,
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+
+    try:
+        streamed = False
+
+        async def stream_turn(question):
+            nonlocal streamed
+            streamed = True
+            async with turn_gate.lock(user_id):
+                history = await chat_storage.get_history(user_id)
+
+                if not history:
+                    await chat_storage.append_messages(user_id, [{"role": "assistant", "content": WEBSITE_WELCOME_TEXT}])
+                    await send_sse(response, {"delta": WEBSITE_WELCOME_TEXT})
+                    return WEBSITE_WELCOME_TEXT
+
+                summary = await chat_storage.get_summary(user_id)
+                questions_count = await chat_storage.count_questions(user_id)
+                parts = []
+                async for delta in brain.stream_answer(question, history, questions_count=questions_count,
+                                                       use_cache=True, summary=summary):
+                    parts.append(delta)
+                    await send_sse(response, {"delta": delta.translate(LINK_CLEANUP)})
+
+                # Историю сохраняем только после полного ответа
+                answer = "".join(parts)
+                await chat_storage.append_messages(user_id, [
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": answer}
+                ])
+            summarizer.notify(user_id)
+            return answer.translate(LINK_CLEANUP)
+
+        # Склеенные вопросы стримятся в поток последнего запроса, остальные получают готовый ответ одним куском
+        answer = await turn_gate.collect_answer(user_id, question, stream_turn)
+        if not streamed:
+            await send_sse(response, {"delta": answer})
+
+        await send_sse(response, {"done": True})
+    except ConnectionResetError:
+        logging.info(f"/ask/stream: посетитель {user_id} закрыл соединение")
+        return response
     except Exception as e:
-        logging.error(f"Error in /ask: {e}")
-        return web.json_response({"error": "Сервер занят, попробуйте позже"}, status=500, headers=headers)
+        logging.error(f"Error in /ask/stream: {e}")
+        await send_sse(response, {"error": "Сервер занят, попробуйте позже"})
+
+    await response.write_eof()
+    return response
+
+
 async def handle_index(request):
     """Для проверки, что сервер жив"""
-    return web.Response(text="Бот и ИИ-менеджер PRO Unity Consult работают!", status=200)
+    role = "лидер" if leader.is_leader else "резерв"
+    return web.Response(text=f"Бот и ИИ-менеджер PRO Unity Consult работают! "
+                             f"Экземпляр {leader.instance_id} ({role})", status=200)
+
+
+async def handle_health(request):
+    """Состояние сервера и внутренних кэшей"""
+    return web.json_response({
+        "status": "running",
+        "time": datetime.now().isoformat(),
+        "instance": leader.stats(),
+        "embedding_cache": brain.embedding_cache.stats(),
+        "embedding_batcher": brain.embedding_batcher.stats(),
+        "answer_cache": brain.answer_cache.stats(),
+        "retrieval": brain.retrieval.stats(),
+        "token_usage": brain.usage_stats(),
+        "summarizer": summarizer.stats(),
+        "turn_gate": turn_gate.stats(),
+        "fsm_storage": fsm_storage.stats(),
+        "broadcast": broadcaster.stats(),
+        "webhook": {"mode": WEBHOOK_MODE, **update_queue.stats()},
+        "vector_index": {"documents": len(brain.vector_index), "version": brain.vector_index.version}
+                        if brain.vector_index is not None else None,
+    })
+
+
+async def handle_funnel_stats(request):
+    """Воронка в JSON: GET /stats/funnel?days=7, заголовок Authorization: Bearer <STATS_TOKEN>"""
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not STATS_TOKEN or token != STATS_TOKEN:
+        return web.json_response({"error": "Forbidden"}, status=403)
+    days = request.query.get("days", "7")
+    days = int(days) if days.isdigit() else 7
+    return web.json_response(await funnel.summary(max(1, min(days, 365))))
+
+
+async def handle_metrics(request):
+    """Метрики в формате Prometheus: задержки и ошибки внешних вызовов, лаг event loop, очереди"""
+    depths = {
+        "webhook_updates": update_queue.qsize(),
+        "sheet_sink": sheet_sink.qsize(),
+        "reminders": reminders.qsize(),
+        "summarizer": summarizer.qsize(),
+        "retrieval": brain.retrieval.pending,
+    }
+    if leader.is_leader:
+        try:
+            depths["outbox_pending"] = await outbox.pending_count()
+        except Exception as e:
+            logging.error(f"/metrics: outbox недоступен: {e}")
+    set_queue_depths(depths)
+    body, content_type = render()
+    return web.Response(body=body, headers={"Content-Type": content_type})
+
+
+# Задержка event loop (долгие синхронные вызовы в обработчиках видны здесь)
+loop_monitor = EventLoopMonitor()
 
 
 # ================== ЗАПУСК ПРИЛОЖЕНИЯ ==================
 
 async def on_startup(app):
+    await db.connect()
+    await chat_storage.init()
+    await fsm_storage.init()
+    await funnel.init()
+    await reminders.init()
+    await outbox.init()
+    if WEBHOOK_MODE == "queue":
+        update_queue.start()
     # Эта строка говорит Телеграму: "Отправляй сообщения на этот адрес"
     await bot.set_webhook(f"{WEBHOOK_URL}/webhook")
-    scheduler.start()
+    summarizer.start()
+    loop_monitor.start()
+    # Дожатие, outbox и расписание стартуют, когда экземпляр станет лидером (один экземпляр — сразу)
+    await leader.start()
     logging.info(">>> Сервер успешно запущен и вебхук установлен")
 
 
+async def on_shutdown(app):
+    # Сначала дообрабатываем принятые апдейты: им еще нужны база, таблицы и очереди ниже
+    await update_queue.close()
+    # Отдаем лидерство: фоновые задачи останавливаются, очередь в таблицы дописывается
+    await leader.close()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await summarizer.close()
+    await loop_monitor.close()
+    await lead_pipeline.close()
+    brain.retrieval.close()
+    await db.close()
+
+
 app = web.Application()
 app.router.add_post("/webhook", handle_webhook)  # Вход для ТГ
 app.router.add_route("*", "/ask", handle_ask_website)  # Вход для Сайта
+app.router.add_route("*", "/ask/stream", handle_ask_stream)  # Сайт, ответ потоком (SSE)
 app.router.add_get("/", handle_index)  # Главная страница
+app.router.add_get("/health", handle_health)  # Состояние и счетчики
+app.router.add_get("/stats/funnel", handle_funnel_stats)  # Воронка для маркетинга
+app.router.add_get("/metrics", handle_metrics)  # Prometheus
 app.on_startup.append(on_startup)
+app.on_shutdown.append(on_shutdown)
 
 if __name__ == "__main__":
     web.run_app(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import os
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+from aiogram import BaseMiddleware
+
+from src.storage import Database
+
+# ================== НАСТРОЙКИ ==================
+FUNNEL_TIMEZONE = pytz.timezone(os.getenv("FUNNEL_TIMEZONE", "Europe/Sofia"))
+
+# Шаги воронки по порядку: состояние анкеты, в которое перешел лид, и подтверждение
+FUNNEL_STEPS = ("name", "role", "business_stage", "partner", "main_task", "time_of_day", "email", "confirmed")
+FUNNEL_STEP_TITLES = {
+    "name": "Старт",
+    "role": "Роль",
+    "business_stage": "Стадия бизнеса",
+    "partner": "Партнер",
+    "main_task": "Задача",
+    "time_of_day": "Время звонка",
+    "email": "Email",
+    "confirmed": "Подтверждено",
+}
+
+
+class FunnelStats:
+    """
+    Воронка анкеты без чтения таблиц.
+    Каждый переход пишется в funnel_events (один раз на шаг для каждой анкеты), и тем же запросом
+    увеличивается счетчик funnel_daily (день, target, source, campaign, шаг).
+    Отчеты читают только funnel_daily.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def init(self):
+        async with self.db.acquire() as conn:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS funnel_events (
+                                      id BIGSERIAL PRIMARY KEY,
+                                      telegram_id TEXT NOT NULL,
+                                      started_at TEXT NOT NULL,
+                                      step TEXT NOT NULL,
+                                      target TEXT NOT NULL,
+                                      source TEXT NOT NULL,
+                                      campaign TEXT NOT NULL,
+                                      day DATE NOT NULL,
+                                      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                                      UNIQUE (telegram_id, started_at, step))''')
+            await conn.execute('''CREATE TABLE IF NOT EXISTS funnel_daily (
+                                      day DATE NOT NULL,
+                                      target TEXT NOT NULL,
+                                      source TEXT NOT NULL,
+                                      campaign TEXT NOT NULL,
+                                      step TEXT NOT NULL,
+                                      count INTEGER NOT NULL DEFAULT 0,
+                                      PRIMARY KEY (day, target, source, campaign, step))''')
+
+    async def record(self, step: str, data: dict):
+        """Лид дошел до шага step; data — данные анкеты (telegram_id, created_at, target, source, campaign)"""
+        if not data.get("telegram_id") or not data.get("created_at"):
+            return  # анкета начата до учета воронки
+        day = datetime.now(FUNNEL_TIMEZONE).date()
+        try:
+            async with self.db.acquire() as conn:
+                await conn.execute('''WITH event AS (
+                                          INSERT INTO funnel_events
+                                              (telegram_id, started_at, step, target, source, campaign, day)
+                                          VALUES ($1, $2, $3, $4, $5, $6, $7)
+                                          ON CONFLICT (telegram_id, started_at, step) DO NOTHING
+                                          RETURNING day, target, source, campaign, step)
+                                      INSERT INTO funnel_daily (day, target, source, campaign, step, count)
+                                      SELECT day, target, source, campaign, step, 1 FROM event
+                                      ON CONFLICT (day, target, source, campaign, step)
+                                      DO UPDATE SET count = funnel_daily.count + 1''',
+                                   str(data["telegram_id"]), str(data["created_at"]), step,
+                                   str(data.get("target", "w")), str(data.get("source", "organic")),
+                                   str(data.get("campaign", "none")), day)
+        except Exception as e:
+            logging.error(f"Воронка: не удалось записать шаг {step}: {e}")
+
+    async def summary(self, days: int = 7):
+        """Счетчики шагов за последние days дней: всего и по кампаниям"""
+        since = datetime.now(FUNNEL_TIMEZONE).date() - timedelta(days=days - 1)
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch('''SELECT target, source, campaign, step, sum(count) AS count
+                                       FROM funnel_daily WHERE day >= $1
+                                       GROUP BY target, source, campaign, step''', since)
+
+        totals = dict.fromkeys(FUNNEL_STEPS, 0)
+        campaigns = {}
+        for row in rows:
+            count = int(row["count"])
+            totals[row["step"]] = totals.get(row["step"], 0) + count
+            key = (row["target"], row["source"], row["campaign"])
+            campaigns.setdefault(key, dict.fromkeys(FUNNEL_STEPS, 0))[row["step"]] = count
+
+        return {
+            "since": since.isoformat(),
+            "days": days,
+            "steps": totals,
+            "campaigns": sorted(
+                ({"target": t, "source": s, "campaign": c, "steps": steps} for (t, s, c), steps in campaigns.items()),
+                key=lambda item: item["steps"].get(FUNNEL_STEPS[0], 0), reverse=True,
+            ),
+        }
+
+
+def format_summary(summary: dict, top: int = 10):
+    """Текст для /stats: воронка с конверсией от старта и лучшие кампании"""
+    steps = summary["steps"]
+    started = steps.get(FUNNEL_STEPS[0], 0)
+    lines = [f"📊 Воронка с {summary['since']} ({summary['days']} дн.)"]
+    for step in FUNNEL_STEPS:
+        share = f" ({100 * steps.get(step, 0) / started:.0f}%)" if started else ""
+        lines.append(f"{FUNNEL_STEP_TITLES[step]}: {steps.get(step, 0)}{share}")
+
+    if summary["campaigns"]:
+        lines.append("")
+        lines.append("Кампании (старт → подтверждено):")
+        for item in summary["campaigns"][:top]:
+            lines.append(f"{item['target']}_{item['source']}_{item['campaign']}: "
+                         f"{item['steps'].get(FUNNEL_STEPS[0], 0)} → {item['steps'].get('confirmed', 0)}")
+    return "\n".join(lines)
+
+
+class FunnelMiddleware(BaseMiddleware):
+    """Outer-middleware апдейта: если хендлер перевел анкету в новое состояние, записываем шаг воронки"""
+
+    def __init__(self, funnel: FunnelStats):
+        self.funnel = funnel
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        if state is None:
+            return await handler(event, data)
+
+        # Повторный /start оставляет то же состояние, но это новая анкета (другой created_at)
+        before = (await state.get_state(), (await state.get_data()).get("created_at"))
+        result = await handler(event, data)
+        after_state = await state.get_state()
+        if after_state is not None:
+            form = await state.get_data()
+            step = after_state.split(":")[-1]
+            if step in FUNNEL_STEPS and (after_state, form.get("created_at")) != before:
+                await self.funnel.record(step, form)
+        return result
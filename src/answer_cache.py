@@ -0,0 +1,92 @@
+import os
+import time
+import numpy as np
+
+# ================== НАСТРОЙКИ ==================
+ANSWER_CACHE_MAX_DISTANCE = float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.08"))  # косинусное расстояние
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))  # секунды
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+
+
+class SemanticAnswerCache:
+    """
+    Кэш готовых ответов на анонимные вопросы с сайта; ответы с именем посетителя сюда не попадают.
+    Ответ переиспользуется, если новый вопрос близок по смыслу к уже заданному
+    (косинусное расстояние <= max_distance) и поиск по базе вернул те же документы.
+    При изменении коллекции knowledge кэш сбрасывается целиком.
+    """
+
+    def __init__(self, max_distance: float = ANSWER_CACHE_MAX_DISTANCE,
+                 ttl: int = ANSWER_CACHE_TTL, max_size: int = ANSWER_CACHE_SIZE):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version = None
+        self._entries = []    # {"doc_ids", "answer", "stored_at"}
+        self._matrix = None   # нормализованные векторы вопросов, строка = запись
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, vector, doc_ids, version):
+        self._check_version(version)
+        self._evict_expired()
+        if not self._entries:
+            self.misses += 1
+            return None
+
+        similarities = self._matrix @ _normalize(vector)
+        doc_ids = tuple(doc_ids)
+        for i in np.argsort(-similarities):
+            if 1.0 - similarities[i] > self.max_distance:
+                break
+            if self._entries[i]["doc_ids"] == doc_ids:
+                self.hits += 1
+                return self._entries[i]["answer"]
+
+        self.misses += 1
+        return None
+
+    def store(self, vector, doc_ids, answer, version):
+        self._check_version(version)
+        self._entries.append({"doc_ids": tuple(doc_ids), "answer": answer, "stored_at": time.time()})
+        row = _normalize(vector)[np.newaxis, :]
+        self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+        if len(self._entries) > self.max_size:
+            self._keep(slice(len(self._entries) - self.max_size, None))
+
+    def invalidate(self):
+        self._entries = []
+        self._matrix = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "size": len(self._entries),
+        }
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+
+    def _evict_expired(self):
+        # Записи добавляются по времени, поэтому устаревшие всегда в начале
+        cutoff = time.time() - self.ttl
+        first_alive = 0
+        while first_alive < len(self._entries) and self._entries[first_alive]["stored_at"] < cutoff:
+            first_alive += 1
+        if first_alive:
+            self._keep(slice(first_alive, None))
+
+    def _keep(self, part: slice):
+        self._entries = self._entries[part]
+        self._matrix = self._matrix[part] if self._entries else None
+
+
+def _normalize(vector):
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
@@ -1,10 +1,112 @@
 import os
+import re
+import time
+import random
+import asyncio
+import logging
 import chromadb
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from src.embedding_cache import EmbeddingCache
+from src.answer_cache import SemanticAnswerCache
+from src.retrieval import RetrievalExecutor
+from src.embedding_batcher import EmbeddingBatcher
+from src.vector_index import InMemoryVectorIndex
+from src.prompt_builder import TokenCounter, PromptBuilder, MESSAGE_OVERHEAD_TOKENS
+from src.metrics import observe, record, timed
+from src.models import EMBEDDING_MODEL, CHAT_MODEL
 
 load_dotenv()
 
+KB_VERSION_CHECK_SECONDS = int(os.getenv("KB_VERSION_CHECK_SECONDS", "60"))
+# chroma — поиск через PersistentClient (HNSW); numpy — точный поиск по снимку коллекции в памяти
+RETRIEVAL_ENGINE = os.getenv("RETRIEVAL_ENGINE", "chroma")
+# split — неизменный префикс промпта первым (его кэширует OpenAI), контекст в конце;
+# legacy — контекст внутри системного промпта; ab — случайно один из двух на каждый запрос
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "split")
+PROMPT_LAYOUTS = ("split", "legacy")
+
+# --- НАСТРОЙКИ ЛИЧНОСТИ ---
+ADMIN_NAME = "Александр"
+CALENDAR_URL = "https://calendar.app.google/PSKoiNJa2BfEM2tJA"
+FALLBACK_ANSWER = f"Извините, сейчас я не могу ответить. Пожалуйста, запишитесь на диагностику: {CALENDAR_URL}"
+
+
+def _system_prompt(context_rule: str):
+    """Общий текст системного промпта для обоих вариантов; различается только то, где искать контекст"""
+    return f"""Ты — {ADMIN_NAME}, администратор консалтинговой компании PRO Unity Consult. 
+
+    ТВОЙ АЛГОРИТМ (ДЕЙСТВУЙ СТРОГО ПО ШАГАМ):
+
+    ШАГ 1: ЗНАКОМСТВО
+    - Если в истории переписки ты еще не знаешь имени клиента, поздоровайся, представься как {ADMIN_NAME} и ОБЯЗАТЕЛЬНО спроси, как зовут собеседника.
+    - Не давай развернутых советов, пока не узнаешь имя.
+
+    ШАГ 2: КВАЛИФИКАЦИЯ ({context_rule})
+    - В ходе беседы тактично узнай: роль клиента в бизнесе, его основную "боль" и семейное положение.
+    - Отвечай по существу, используя ПРЕДОСТАВЛЕННЫЙ КОНТЕКСТ.
+    - ВАЖНО: Если в контексте нет информации об услуге или цене — НЕ ПРИДУМЫВАЙ. Скажи: 'У меня нет точных данных в базе по этому вопросу, но эксперт расскажет об этом на диагностике'.
+
+    ШАГ 3: ПРЕДЛОЖЕНИЕ ЗАПИСИ
+    - В конце каждого содержательного ответа предлагай записаться на консультацию для детального разбора.
+    - Ссылка для записи: {CALENDAR_URL}
+
+    ПРАВИЛА:
+    - Говори на языке клиента, будь вежлив и профессионален.
+    - Используй ТОЛЬКО простой текст. Запрещено использовать разметку Markdown (квадратные или круглые скобки для ссылок). 
+    - Пиши ссылку {CALENDAR_URL} просто текстом, чтобы она была видна и кликабельна везде.
+    """
+
+
+def build_system_prompt(context: str):
+    """Прежний вариант (PROMPT_LAYOUT=legacy): контекст внутри единого системного промпта"""
+    return _system_prompt(f"Используй контекст: {context}")
+
+
+def build_static_prompt():
+    """Неизменная часть системного промпта: собирается один раз и идет первым сообщением"""
+    return _system_prompt("Используй КОНТЕКСТ из последнего системного сообщения перед вопросом")
+
+
+def build_dynamic_prompt(context: str, intro_instruction: str):
+    """Меняющаяся часть: инструкция по имени и найденный контекст, идет сразу перед вопросом"""
+    return f"{intro_instruction}\n\nКОНТЕКСТ:\n{context or 'нет данных'}"
+
+
+# Реплики, которыми бот (приветствие сайта, анкета или сама модель) спрашивает имя
+NAME_PROMPT_MARKERS = ("как к вам можно обращаться", "как к вам обращаться", "как вас зовут", "как вас называть")
+NAME_REPLY_STOPWORDS = {"меня", "зовут", "мое", "моё", "имя", "это", "можно", "просто", "здравствуйте", "привет"}
+
+
+def asks_for_name(chat_history: list):
+    """Последняя реплика бота спрашивала имя — значит, текущий вопрос, скорее всего, и есть имя"""
+    for msg in reversed(chat_history):
+        if msg.get("role") == "assistant":
+            text = (msg.get("content") or "").lower()
+            return any(marker in text for marker in NAME_PROMPT_MARKERS)
+    return False
+
+
+def visitor_name_words(chat_history: list, user_name: str = None):
+    """
+    Слова, которые могут быть именем посетителя: из ответов на вопрос об имени —
+    слова с заглавной буквы, а короткий ответ («анна») целиком
+    """
+    words = set()
+    if user_name and user_name != "Гость":
+        words.update(w.lower() for w in re.findall(r"\w{2,}", user_name))
+    for prev, msg in zip(chat_history, chat_history[1:]):
+        if msg.get("role") != "user" or not asks_for_name([prev]):
+            continue
+        reply = re.findall(r"\w{2,}", msg.get("content") or "")
+        words.update(w.lower() for w in reply if len(reply) <= 3 or w[:1].isupper())
+    words -= NAME_REPLY_STOPWORDS
+    return words
+
+
+def mentions_any(text: str, words: set):
+    return bool(words) and any(w.lower() in words for w in re.findall(r"\w{2,}", text))
+
 
 class AssistantBrain:
     def __init__(self):
@@ -17,46 +119,143 @@ class AssistantBrain:
         # Подключаемся к векторной базе ChromaDB
         self.db_client = chromadb.PersistentClient(path=db_path)
         self.collection = self.db_client.get_or_create_collection("knowledge")
+        # Запросы к Chroma синхронные — выполняем их вне event loop, с лимитом и таймаутом
+        self.retrieval = RetrievalExecutor()
+        self.vector_index = InMemoryVectorIndex() if RETRIEVAL_ENGINE == "numpy" else None
+        self._index_reload = None
+
+        # Бюджет токенов на промпт и учет расхода
+        self.token_counter = TokenCounter(CHAT_MODEL)
+        self.prompt_builder = PromptBuilder(self.token_counter)
+        self.token_usage = {
+            layout: {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                     "total_latency": 0.0}
+            for layout in PROMPT_LAYOUTS
+        }
+        self.prompt_layout = PROMPT_LAYOUT
+        if self.prompt_layout not in PROMPT_LAYOUTS + ("ab",):
+            logging.warning(f"PROMPT_LAYOUT={PROMPT_LAYOUT!r} не распознан (split, legacy, ab), используем split")
+            self.prompt_layout = "split"
+        self.static_prompt = build_static_prompt()
+        self._static_prompt_tokens = self.token_counter.count(self.static_prompt)
+
+        # Кэш векторов: повторяющиеся вопросы не ходят в OpenAI
+        self.embedding_cache = EmbeddingCache(os.path.join(db_path, "embedding_cache.sqlite3"))
+        # Одновременные вопросы разных пользователей уходят в OpenAI одной пачкой
+        self.embedding_batcher = EmbeddingBatcher(self.client_ai, EMBEDDING_MODEL)
+        # Кэш готовых ответов для частых вопросов с сайта
+        self.answer_cache = SemanticAnswerCache()
+        self._kb_version = None
+        self._kb_version_checked_at = 0.0
+
+    def _read_knowledge_version(self):
+        # get_collection перечитывает метаданные (kb_version пишет sync_kb)
+        collection = self.db_client.get_collection("knowledge")
+        metadata = collection.metadata or {}
+        return collection.count(), metadata.get("kb_version")
+
+    async def knowledge_version(self):
+        """Отпечаток коллекции knowledge: меняется, когда базу знаний перезаливают"""
+        now = time.monotonic()
+        if self._kb_version is None or now - self._kb_version_checked_at > KB_VERSION_CHECK_SECONDS:
+            self._kb_version_checked_at = now
+            version = await self.retrieval.run(self._read_knowledge_version)
+            if version is not None:
+                self._kb_version = version
+        return self._kb_version
+
+    async def _refresh_vector_index(self):
+        """Если коллекция изменилась — перестраиваем снимок в фоне, пока отвечаем по старому"""
+        version = await self.knowledge_version()
+        if self.vector_index.ready and self.vector_index.version == version:
+            return
+        if self._index_reload is None or self._index_reload.done():
+            self._index_reload = asyncio.create_task(self._reload_vector_index(version))
+        if not self.vector_index.ready:
+            await asyncio.shield(self._index_reload)
+
+    async def _reload_vector_index(self, version):
+        loop = asyncio.get_running_loop()
+        try:
+            count = await loop.run_in_executor(self.retrieval.executor, self.vector_index.load,
+                                               self.collection, version)
+            logging.info(f"Векторный индекс в памяти: загружено {count} документов (версия {version})")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки векторного индекса: {e}")
+
+    async def search(self, query_vector, n_results: int = 3):
+        """Поиск по базе знаний. None — поиск недоступен, отвечаем без контекста"""
+        if self.vector_index is not None:
+            await self._refresh_vector_index()
+            if self.vector_index.ready:
+                return self.vector_index.query([query_vector], n_results=n_results)
+        return await self.retrieval.run(
+            self._query_collection,
+            query_embeddings=[query_vector],
+            n_results=n_results
+        )
+
+    @timed("chroma", "query")
+    def _query_collection(self, **kwargs):
+        # Выполняется в потоке RetrievalExecutor
+        return self.collection.query(**kwargs)
 
     async def get_embedding(self, text):
-        """Получаем вектор через OpenAI"""
+        """Получаем вектор через OpenAI (сначала смотрим в кэш)"""
         text = text.replace("\n", " ")
-        response = await self.client_ai.embeddings.create(
-            input=[text],
-            model="text-embedding-3-small"
-        )
-        return response.data[0].embedding
+        cached = await self.embedding_cache.get(text, EMBEDDING_MODEL)
+        if cached is not None:
+            return cached
+
+        vector = await self.embedding_batcher.embed(text)
+        await self.embedding_cache.put(text, EMBEDDING_MODEL, vector)
+        return vector
 
-    async def get_answer(self, user_question: str, chat_history: list = None, user_name: str = None):
+    async def _prepare(self, user_question: str, chat_history: list, user_name: str,
+                       questions_count: int, use_cache: bool, summary: str = None):
         """
-        Генерирует ответ, учитывая знания из базы и историю переписки.
+        Общая подготовка хода для get_answer и stream_answer.
+        Возвращает dict: answer — готовый ответ без обращения к GPT (лимит, кэш),
+        иначе messages для GPT и cache — (вектор, id документов), если ответ можно закэшировать.
         """
         if chat_history is None:
             chat_history = []
 
         # --- 1. ОГРАНИЧЕНИЕ КОЛИЧЕСТВА ВОПРОСОВ ---
-        # Считаем сообщения пользователя в истории
-        user_questions_count = sum(1 for msg in chat_history if msg.get("role") == "user")
+        # Считаем сообщения пользователя в истории, если хранилище не дало готовый счетчик
+        if questions_count is None:
+            user_questions_count = sum(1 for msg in chat_history if msg.get("role") == "user")
+        else:
+            user_questions_count = questions_count
 
         if user_questions_count >= 5:
-            return (
+            return {"answer": (
                 "Вижу, у вас много глубоких вопросов! Чтобы разобрать вашу ситуацию "
                 "максимально точно, я приглашаю вас на диагностику. Там мы разберем всё "
-                "профессионально. Записаться можно здесь: https://calendar.app.google/PSKoiNJa2BfEM2tJA"
-            )
+                f"профессионально. Записаться можно здесь: {CALENDAR_URL}"
+            )}
 
         # --- 2. ПОИСК РЕЛЕВАНТНЫХ ЗНАНИЙ (ChromaDB) ---
         query_vector = await self.get_embedding(user_question)
-        results = self.collection.query(
-            query_embeddings=[query_vector],
-            n_results=3
-        )
-        context = " ".join(results['documents'][0]) if results['documents'] else ""
+        results = await self.search(query_vector, n_results=3)
+        if results is None:
+            # Поиск перегружен или не успел — отвечаем без контекста и такой ответ не кэшируем
+            results = {}
+            use_cache = False
+        # Документы идут по убыванию релевантности — при нехватке бюджета отбрасываются с конца
+        documents = list(results['documents'][0]) if results.get('documents') else []
+        doc_ids = results['ids'][0] if results.get('ids') else []
 
-        # --- 3. НАСТРОЙКИ ЛИЧНОСТИ И ПРАВИЛА ---
-        ADMIN_NAME = "Александр"
-        CALENDAR_URL = "https://calendar.app.google/PSKoiNJa2BfEM2tJA"
+        # Кэш ищет только по вопросу и найденным документам. Не кэшируем персональное:
+        # известное имя и ответ на вопрос «как к вам обращаться» (это сама реплика с именем)
+        personal_words = visitor_name_words(chat_history, user_name)
+        use_cache = use_cache and not (user_name and user_name != "Гость") and not asks_for_name(chat_history)
+        if use_cache:
+            cached = self.answer_cache.lookup(query_vector, doc_ids, await self.knowledge_version())
+            if cached is not None:
+                return {"answer": cached}
 
+        # --- 3. НАСТРОЙКИ ЛИЧНОСТИ И ПРАВИЛА ---
         # Если имя передано, мы говорим Александру, что он уже знает клиента
         intro_instruction = ""
         if user_name and user_name != "Гость":
@@ -64,48 +263,159 @@ class AssistantBrain:
         else:
             intro_instruction = "Если ты еще не знаешь имени клиента, представься и спроси, как его зовут."
 
-        system_prompt = f"""Ты — {ADMIN_NAME}, администратор консалтинговой компании PRO Unity Consult. 
+        layout = random.choice(PROMPT_LAYOUTS) if self.prompt_layout == "ab" else self.prompt_layout
 
-    ТВОЙ АЛГОРИТМ (ДЕЙСТВУЙ СТРОГО ПО ШАГАМ):
-
-    ШАГ 1: ЗНАКОМСТВО
-    - Если в истории переписки ты еще не знаешь имени клиента, поздоровайся, представься как {ADMIN_NAME} и ОБЯЗАТЕЛЬНО спроси, как зовут собеседника.
-    - Не давай развернутых советов, пока не узнаешь имя.
-
-    ШАГ 2: КВАЛИФИКАЦИЯ (Используй контекст: {context})
-    - В ходе беседы тактично узнай: роль клиента в бизнесе, его основную "боль" и семейное положение.
-    - Отвечай по существу, используя ПРЕДОСТАВЛЕННЫЙ КОНТЕКСТ.
-    - ВАЖНО: Если в контексте нет информации об услуге или цене — НЕ ПРИДУМЫВАЙ. Скажи: 'У меня нет точных данных в базе по этому вопросу, но эксперт расскажет об этом на диагностике'.
+        # --- 4. ФОРМИРОВАНИЕ ПАКЕТА СООБЩЕНИЙ (в пределах бюджета токенов) ---
+        # Вопрос входит всегда, поэтому длинную вставку обрезаем так же, как реплики истории
+        user_question = self.token_counter.truncate(user_question, self.prompt_builder.max_message_tokens)
+        fixed_tokens = self.token_counter.count(user_question) + 2 * MESSAGE_OVERHEAD_TOKENS
+        if layout == "split":
+            fixed_tokens += (self._static_prompt_tokens + MESSAGE_OVERHEAD_TOKENS
+                             + self.token_counter.count(build_dynamic_prompt("", intro_instruction)))
+        else:
+            fixed_tokens += self.token_counter.count(build_system_prompt(""))
+        documents, history, summary, usage = self.prompt_builder.fit(
+            fixed_tokens, documents, chat_history[-10:], summary)
+        context = " ".join(documents)
 
-    ШАГ 3: ПРЕДЛОЖЕНИЕ ЗАПИСИ
-    - В конце каждого содержательного ответа предлагай записаться на консультацию для детального разбора.
-    - Ссылка для записи: {CALENDAR_URL}
+        # split: сначала то, что не меняется (промпт, сводка, история) — этот префикс кэшируется,
+        # контекст и имя — отдельным сообщением прямо перед вопросом
+        if layout == "split":
+            messages = [{"role": "system", "content": self.static_prompt}]
+        else:
+            messages = [{"role": "system", "content": build_system_prompt(context)}]
 
-    ПРАВИЛА:
-    - Говори на языке клиента, будь вежлив и профессионален.
-    - Используй ТОЛЬКО простой текст. Запрещено использовать разметку Markdown (квадратные или круглые скобки для ссылок). 
-    - Пиши ссылку {CALENDAR_URL} просто текстом, чтобы она была видна и кликабельна везде.
-    """
+        # Сводка ранней переписки (если есть) — перед последними сообщениями
+        if summary:
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущей переписки: {summary}"})
 
-        # --- 4. ФОРМИРОВАНИЕ ПАКЕТА СООБЩЕНИЙ ---
-        messages = [{"role": "system", "content": system_prompt}]
+        # Последние сообщения для памяти (сколько влезло в бюджет)
+        messages.extend(history)
 
-        # Добавляем последние 10 сообщений для памяти
-        if chat_history:
-            messages.extend(chat_history[-10:])
+        if layout == "split":
+            messages.append({"role": "system", "content": build_dynamic_prompt(context, intro_instruction)})
 
         # Добавляем текущий вопрос пользователя
         messages.append({"role": "user", "content": user_question})
 
+        return {
+            "answer": None,
+            "messages": messages,
+            "cache": (query_vector, doc_ids, personal_words, bool(summary)) if use_cache else None,
+            "usage": usage,
+            "layout": layout,
+        }
+
+    def _record_usage(self, turn: dict, usage, latency: float):
+        """Сверяем оценку промпта с фактическим расходом OpenAI и копим счетчики по вариантам промпта"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        totals = self.token_usage[turn["layout"]]
+        totals["requests"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+        totals["completion_tokens"] += usage.completion_tokens
+        totals["total_latency"] += latency
+        estimate = turn["usage"]
+        logging.info(
+            f"Токены ({turn['layout']}): промпт {usage.prompt_tokens}, из кэша {cached_tokens} "
+            f"(оценка {estimate['total']} из {estimate['budget']}: "
+            f"контекст {estimate['context']}, история {estimate['history']}, сводка {estimate['summary']}; "
+            f"отброшено кусков {estimate['dropped_chunks']}, реплик {estimate['dropped_messages']}), "
+            f"ответ {usage.completion_tokens}, {latency:.2f} c"
+        )
+
+    def usage_stats(self):
+        """Сравнение вариантов промпта: средняя задержка и доля токенов из кэша"""
+        stats = {}
+        for layout, totals in self.token_usage.items():
+            requests = totals["requests"]
+            stats[layout] = {
+                "requests": requests,
+                "prompt_tokens": totals["prompt_tokens"],
+                "cached_tokens": totals["cached_tokens"],
+                "completion_tokens": totals["completion_tokens"],
+                "cached_share": round(totals["cached_tokens"] / totals["prompt_tokens"], 3)
+                                if totals["prompt_tokens"] else 0.0,
+                "avg_latency_ms": round(1000 * totals["total_latency"] / requests, 1) if requests else 0.0,
+            }
+        return stats
+
+    async def _remember_answer(self, turn: dict, answer: str):
+        if turn["cache"] is not None and answer:
+            query_vector, doc_ids, personal_words, has_summary = turn["cache"]
+            # Ответ обращается к посетителю по имени (или имя могло остаться только в сводке) — не храним
+            if has_summary or mentions_any(answer, personal_words):
+                return
+            self.answer_cache.store(query_vector, doc_ids, answer, await self.knowledge_version())
+
+    async def get_answer(self, user_question: str, chat_history: list = None, user_name: str = None,
+                         questions_count: int = None, use_cache: bool = False, summary: str = None):
+        """
+        Генерирует ответ, учитывая знания из базы и историю переписки.
+        questions_count — сколько вопросов пользователь задал за всё время
+        (история может быть только последним окном, поэтому счетчик передается отдельно).
+        use_cache — можно ли взять готовый ответ на похожий вопрос (кроме персональных ответов).
+        summary — сводка ранней переписки, которая уже не входит в историю.
+        """
+        turn = await self._prepare(user_question, chat_history, user_name, questions_count, use_cache, summary)
+        if turn["answer"] is not None:
+            return turn["answer"]
+
         # --- 5. ЗАПРОС К GPT ---
+        started = time.perf_counter()
+        try:
+            with observe("openai", "completion"):
+                response = await self.client_ai.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=turn["messages"],
+                    temperature=0.3  # Низкая температура снижает риск выдумок
+                )
+            answer = response.choices[0].message.content
+            self._record_usage(turn, response.usage, time.perf_counter() - started)
+            await self._remember_answer(turn, answer)
+            return answer
+        except Exception as e:
+            logging.error(f"OpenAI Error: {e}")
+            return FALLBACK_ANSWER
+
+    async def stream_answer(self, user_question: str, chat_history: list = None, user_name: str = None,
+                            questions_count: int = None, use_cache: bool = False, summary: str = None):
+        """
+        То же, что get_answer, но отдает ответ кусками по мере генерации (stream=True).
+        Готовые ответы (лимит, кэш) приходят одним куском.
+        """
+        turn = await self._prepare(user_question, chat_history, user_name, questions_count, use_cache, summary)
+        if turn["answer"] is not None:
+            yield turn["answer"]
+            return
+
+        parts = []
+        started = time.perf_counter()
         try:
-            response = await self.client_ai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                temperature=0.3  # Низкая температура снижает риск выдумок
+            stream = await self.client_ai.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=turn["messages"],
+                temperature=0.3,
+                stream=True,
+                stream_options={"include_usage": True}  # расход токенов приходит последним куском
             )
-            return response.choices[0].message.content
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_usage(turn, chunk.usage, time.perf_counter() - started)
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
         except Exception as e:
-            import logging
+            record("openai", "completion_stream", time.perf_counter() - started, error=True)
             logging.error(f"OpenAI Error: {e}")
-            return f"Извините, сейчас я не могу ответить. Пожалуйста, запишитесь на диагностику: {CALENDAR_URL}"
\ No newline at end of file
+            if not parts:
+                yield FALLBACK_ANSWER
+            return
+        # Время до последнего куска (включая паузы, пока получатель отправлял предыдущие)
+        record("openai", "completion_stream", time.perf_counter() - started)
+
+        await self._remember_answer(turn, "".join(parts))
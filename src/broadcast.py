@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+# ================== НАСТРОЙКИ ==================
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))                # сообщений в секунду (лимит Телеграма ~30)
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1.0"))  # секунд между сообщениями в один чат
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+SENT = "sent"
+BLOCKED = "blocked"  # бот заблокирован, чат удален — повторять бессмысленно
+FAILED = "failed"
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше capacity подряд; pause — после RetryAfter от Телеграма"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    """
+    Массовая отправка сообщений в пределах лимитов Телеграма.
+    Общее ведро токенов на бота, не чаще одного сообщения в chat_interval в один чат,
+    до concurrency отправок одновременно. RetryAfter останавливает всю рассылку на указанное время
+    и повторяет сообщение; заблокировавших бота не повторяем.
+    """
+
+    def __init__(self, bot, rate: float = BROADCAST_RATE, chat_interval: float = BROADCAST_CHAT_INTERVAL,
+                 concurrency: int = BROADCAST_CONCURRENCY, max_retries: int = BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chat_next = {}  # chat_id -> когда можно следующее сообщение (monotonic)
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    async def send_many(self, messages: list, **kwargs):
+        """messages — [(chat_id, text)]; возвращает статусы SENT / BLOCKED / FAILED в том же порядке"""
+        if not messages:
+            return []
+        results = await asyncio.gather(*(self._send(chat_id, text, kwargs) for chat_id, text in messages))
+        now = time.monotonic()
+        self._chat_next = {chat: at for chat, at in self._chat_next.items() if at > now}
+        logging.info(f"Рассылка: {results.count(SENT)} отправлено, {results.count(BLOCKED)} недоступно, "
+                     f"{results.count(FAILED)} ошибок из {len(messages)}")
+        return results
+
+    async def _chat_slot(self, chat_id):
+        now = time.monotonic()
+        at = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = at + self.chat_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _send(self, chat_id, text: str, kwargs: dict):
+        async with self._semaphore:
+            for _ in range(self.max_retries + 1):
+                await self._chat_slot(chat_id)
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id, text, **kwargs)
+                    self.sent += 1
+                    return SENT
+                except TelegramRetryAfter as e:
+                    self.retry_after += 1
+                    logging.warning(f"Рассылка: flood control, пауза {e.retry_after} c")
+                    self.bucket.pause(e.retry_after)
+                except TelegramForbiddenError as e:
+                    self.blocked += 1
+                    logging.info(f"Рассылка: {chat_id} недоступен ({e.message})")
+                    return BLOCKED
+                except TelegramBadRequest as e:
+                    if "chat not found" in str(e).lower():
+                        self.blocked += 1
+                        return BLOCKED
+                    self.failed += 1
+                    logging.error(f"Рассылка: ошибка для {chat_id}: {e}")
+                    return FAILED
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Рассылка: ошибка для {chat_id}: {e}")
+                    return FAILED
+            self.failed += 1
+            return FAILED
+
+    def stats(self):
+        return {"sent": self.sent, "blocked": self.blocked, "failed": self.failed, "retry_after": self.retry_after}
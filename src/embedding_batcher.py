@@ -0,0 +1,94 @@
+import os
+import asyncio
+
+from src.metrics import observe
+
+# ================== НАСТРОЙКИ ==================
+EMBEDDING_BATCH_WINDOW = float(os.getenv("EMBEDDING_BATCH_WINDOW", "0.005"))  # секунды
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "64"))
+
+
+class EmbeddingBatcher:
+    """
+    Склеивает одновременные запросы векторов в один вызов embeddings.create.
+    Тексты, пришедшие в течение window секунд (но не больше max_batch), уходят одной пачкой,
+    каждый вызывающий получает свой вектор. Работает одинаково для Телеграма и сайта.
+    """
+
+    def __init__(self, client, model: str, window: float = EMBEDDING_BATCH_WINDOW,
+                 max_batch: int = EMBEDDING_MAX_BATCH):
+        self.client = client
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []   # (text, future)
+        self._timer = None
+        self._tasks = set()
+        self.requests = 0    # вызовов API
+        self.texts = 0       # векторов выдано
+
+    async def embed(self, text: str):
+        # Пустую строку OpenAI отклоняет с 400 — и вместе с ней всю пачку чужих запросов
+        if not text or not text.strip():
+            raise ValueError("Пустой текст для эмбеддинга")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        # Одинаковые тексты в пачке считаем один раз
+        unique = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = await self._create(unique)
+            errors = {}
+        except Exception as e:
+            if len(unique) == 1 or getattr(e, "status_code", None) != 400:
+                # Сеть, квота, сбой OpenAI — повтор по одной не поможет
+                vectors, errors = {}, dict.fromkeys(unique, e)
+            else:
+                # Одна плохая строка роняет всю пачку (400) — повторяем по одной, чтобы ошибка досталась только ей
+                results = await asyncio.gather(*(self._create([text]) for text in unique), return_exceptions=True)
+                vectors = {}
+                errors = {}
+                for text, result in zip(unique, results):
+                    if isinstance(result, BaseException):
+                        errors[text] = result
+                    else:
+                        vectors.update(result)
+
+        self.texts += sum(1 for text, _ in batch if text in vectors)
+        for text, future in batch:
+            if future.done():
+                continue
+            if text in vectors:
+                future.set_result(vectors[text])
+            else:
+                future.set_exception(errors[text])
+
+    async def _create(self, texts: list):
+        with observe("openai", "embedding"):
+            response = await self.client.embeddings.create(input=texts, model=self.model)
+        self.requests += 1
+        return {texts[item.index]: item.embedding for item in response.data}
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "texts": self.texts,
+            "avg_batch": round(self.texts / self.requests, 2) if self.requests else 0.0,
+        }
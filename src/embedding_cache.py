@@ -0,0 +1,98 @@
+import os
+import time
+import array
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ================== НАСТРОЙКИ ==================
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2000"))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))  # секунды
+
+
+class EmbeddingCache:
+    """
+    Двухуровневый кэш векторов: LRU в памяти процесса + SQLite рядом с chroma.sqlite3,
+    чтобы кэш переживал рестарты. Ключ — sha256 от модели и нормализованного текста.
+    """
+
+    def __init__(self, path: str, max_size: int = EMBEDDING_CACHE_SIZE, ttl: int = EMBEDDING_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (vector, stored_at)
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS embeddings
+                              (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at_idx ON embeddings (created_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text: str, model: str):
+        normalized = " ".join(text.lower().split())
+        return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    async def get(self, text: str, model: str):
+        key = self.make_key(text, model)
+        now = time.time()
+
+        item = self._memory.get(key)
+        if item is not None:
+            vector, stored_at = item
+            if now - stored_at < self.ttl:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return vector
+            del self._memory[key]
+
+        row = await asyncio.to_thread(self._disk_get, key)
+        if row is not None:
+            blob, stored_at = row
+            if now - stored_at < self.ttl:
+                vector = array.array("f", blob).tolist()
+                self._remember(key, vector, stored_at)
+                self.hits_disk += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    async def put(self, text: str, model: str, vector: list):
+        key = self.make_key(text, model)
+        stored_at = time.time()
+        self._remember(key, vector, stored_at)
+        await asyncio.to_thread(self._disk_put, key, array.array("f", vector).tobytes(), stored_at)
+
+    def stats(self):
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else 0.0,
+            "memory_size": len(self._memory),
+        }
+
+    def _remember(self, key, vector, stored_at):
+        self._memory[key] = (vector, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+
+    def _disk_put(self, key, blob, stored_at):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                               (key, blob, stored_at))
+            # Устаревшие записи чистим тут же, без отдельного задания
+            self._conn.execute("DELETE FROM embeddings WHERE created_at < ?", (stored_at - self.ttl,))
+            self._conn.commit()
@@ -0,0 +1,159 @@
+import os
+import copy
+import time
+import logging
+import contextvars
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from src.storage import Database
+from src.metrics import observe
+
+# ================== НАСТРОЙКИ ==================
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+# Сколько секунд доверяем копии в памяти на одном экземпляре; при нескольких кэш чтения выключается
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "30"))
+
+# Записи текущего апдейта: ключ -> запись кэша. Пусто вне FSMFlushMiddleware — тогда пишем сразу
+_pending_writes = contextvars.ContextVar("fsm_pending_writes", default=None)
+
+
+def storage_key(key: StorageKey):
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id,
+        getattr(key, "business_connection_id", None), key.destiny,
+    ))
+
+
+class PostgresFSMStorage(BaseStorage):
+    """
+    Состояние анкеты (aiogram FSM) в Postgres, чтобы незаполненные анкеты переживали деплой
+    и были видны всем экземплярам бота.
+    Чтение — через LRU-кэш в памяти с TTL. Запись в пределах одного апдейта копится в памяти
+    и уходит в базу одним запросом после обработки (FSMFlushMiddleware).
+    ttl=0 — для нескольких экземпляров: анкету мог поменять другой, поэтому каждое чтение идет в базу
+    (кроме несохраненных записей текущего апдейта).
+    """
+
+    def __init__(self, db: Database, cache_size: int = FSM_CACHE_SIZE, ttl: float = FSM_CACHE_TTL):
+        self.db = db
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # ключ -> [state, data, загружено (monotonic)]
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    async def init(self):
+        async with self.db.acquire() as conn:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS fsm_states (
+                                      key TEXT PRIMARY KEY,
+                                      state TEXT,
+                                      data JSONB NOT NULL DEFAULT '{}',
+                                      updated_at TIMESTAMPTZ NOT NULL DEFAULT now())''')
+
+    async def _entry(self, key: str):
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[2] < self.ttl:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        # Несохраненные записи этого апдейта важнее базы
+        pending = _pending_writes.get()
+        if entry is not None and pending is not None and key in pending:
+            return entry
+
+        self.misses += 1
+        with observe("postgres", "fsm_get"):
+            async with self.db.acquire() as conn:
+                row = await conn.fetchrow("SELECT state, data FROM fsm_states WHERE key = $1", key)
+        entry = [row["state"], row["data"] or {}, time.monotonic()] if row else [None, {}, time.monotonic()]
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key: str, entry: list):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _write(self, key: str, entry: list):
+        entry[2] = time.monotonic()
+        self._remember(key, entry)
+        pending = _pending_writes.get()
+        if pending is not None:
+            pending[key] = entry
+        else:
+            await self._save({key: entry})
+
+    async def _save(self, entries: dict):
+        upserts = [(k, e[0], e[1]) for k, e in entries.items() if e[0] is not None or e[1]]
+        deletes = [(k,) for k, e in entries.items() if e[0] is None and not e[1]]
+        with observe("postgres", "fsm_save"):
+            async with self.db.acquire() as conn:
+                async with conn.transaction():
+                    if upserts:
+                        await conn.executemany('''INSERT INTO fsm_states (key, state, data) VALUES ($1, $2, $3)
+                                                  ON CONFLICT (key) DO UPDATE
+                                                  SET state = EXCLUDED.state, data = EXCLUDED.data,
+                                                      updated_at = now()''', upserts)
+                    if deletes:
+                        # Анкета сброшена (state.clear()) — строку не храним
+                        await conn.executemany("DELETE FROM fsm_states WHERE key = $1", deletes)
+        self.writes += 1
+
+    async def flush(self, entries: dict):
+        if not entries:
+            return
+        try:
+            await self._save(entries)
+        except Exception as e:
+            logging.error(f"Postgres FSM: не удалось сохранить {len(entries)} анкет: {e}")
+            # Копия в памяти могла разойтись с базой — при следующем чтении перечитаем
+            for key in entries:
+                self._cache.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state=None):
+        k = storage_key(key)
+        entry = await self._entry(k)
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._write(k, entry)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._entry(storage_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict):
+        k = storage_key(key)
+        entry = await self._entry(k)
+        entry[1] = copy.deepcopy(data)
+        await self._write(k, entry)
+
+    async def get_data(self, key: StorageKey):
+        return copy.deepcopy((await self._entry(storage_key(key)))[1])
+
+    async def close(self):
+        # Пул соединений закрывает владелец Database
+        self._cache.clear()
+
+    def stats(self):
+        return {"cached": len(self._cache), "hits": self.hits, "misses": self.misses, "writes": self.writes}
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Outer-middleware апдейта: все изменения анкеты за апдейт сохраняются одной транзакцией в конце"""
+
+    def __init__(self, storage: PostgresFSMStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        pending = {}
+        token = _pending_writes.set(pending)
+        try:
+            return await handler(event, data)
+        finally:
+            _pending_writes.reset(token)
+            await self.storage.flush(pending)
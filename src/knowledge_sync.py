@@ -0,0 +1,121 @@
+import os
+import re
+import hashlib
+import logging
+
+from src.models import EMBEDDING_MODEL
+
+# ================== НАСТРОЙКИ ==================
+KB_CHUNK_SIZE = int(os.getenv("KB_CHUNK_SIZE", "1000"))        # символов в куске
+KB_CHUNK_OVERLAP = int(os.getenv("KB_CHUNK_OVERLAP", "200"))   # перекрытие соседних кусков
+KB_EMBED_BATCH = int(os.getenv("KB_EMBED_BATCH", "100"))       # текстов в одном вызове embeddings
+SOURCE_EXTENSIONS = (".md", ".markdown", ".txt")
+
+# Экспорт Notion добавляет к именам файлов id страницы: "Цены 1a2b...32 символа.md"
+NOTION_ID_SUFFIX = re.compile(r"\s[0-9a-f]{32}$")
+
+
+def read_sources(source_dir: str):
+    """Все Markdown/TXT файлы (включая экспорт Notion): {относительный путь: текст}"""
+    # os.walk по несуществующей папке молча ничего не вернет — и синхронизация удалила бы всю базу
+    if not os.path.isdir(source_dir):
+        raise FileNotFoundError(f"Папка с документами не найдена: {source_dir}")
+    sources = {}
+    for root, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            if not name.lower().endswith(SOURCE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, source_dir).replace(os.sep, "/")
+            stem, ext = os.path.splitext(rel)
+            with open(path, encoding="utf-8") as f:
+                sources[NOTION_ID_SUFFIX.sub("", stem) + ext] = f.read()
+    return sources
+
+
+def chunk_text(text: str, size: int = KB_CHUNK_SIZE, overlap: int = KB_CHUNK_OVERLAP):
+    """Режем по абзацам до size символов; каждый следующий кусок начинается с хвоста предыдущего"""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    chunks, current = [], ""
+    for paragraph in paragraphs:
+        # Слишком длинный абзац — режем окном
+        while len(paragraph) > size:
+            head, paragraph = paragraph[:size], paragraph[size - overlap:]
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(head)
+        candidate = f"{current}\n\n{paragraph}" if current else paragraph
+        if len(candidate) <= size:
+            current = candidate
+        else:
+            chunks.append(current)
+            tail = current[-overlap:] if overlap else ""
+            current = f"{tail}\n\n{paragraph}" if tail and len(tail) + len(paragraph) + 2 <= size else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_chunks(sources: dict):
+    """{id: (текст, метаданные)}; id — хэш источника и содержимого, поэтому неизменный кусок не пересчитывается"""
+    chunks = {}
+    for source, text in sources.items():
+        for chunk in chunk_text(text):
+            content_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+            chunk_id = hashlib.sha256(f"{source}\n{content_hash}".encode("utf-8")).hexdigest()[:32]
+            chunks[chunk_id] = (chunk, {"source": source, "content_hash": content_hash})
+    return chunks
+
+
+def sync_collection(collection, make_client, source_dir: str, dry_run: bool = False, prune_unmanaged: bool = False,
+                    allow_empty: bool = False):
+    """
+    Инкрементальная синхронизация коллекции knowledge с папкой источников:
+    новые/измененные куски эмбеддятся пачками, удаленные убираются из Chroma.
+    Документы, загруженные не через sync_kb (без content_hash), не трогаем без prune_unmanaged.
+    make_client() создает клиент OpenAI — только если есть что эмбеддить (dry-run работает без ключа).
+    Если в папке нет ни одного документа, ничего не удаляем без allow_empty.
+    """
+    sources = read_sources(source_dir)
+    if not sources and not allow_empty:
+        raise ValueError(f"В {source_dir} нет документов ({', '.join(SOURCE_EXTENSIONS)}); "
+                         f"чтобы очистить базу, запустите с --allow-empty")
+    chunks = build_chunks(sources)
+
+    existing = collection.get(include=["metadatas"])
+    managed = {i for i, meta in zip(existing["ids"], existing["metadatas"] or [])
+               if meta and "content_hash" in meta}
+    known = set(existing["ids"]) if prune_unmanaged else managed
+
+    existing_ids = set(existing["ids"])
+    to_add = [i for i in chunks if i not in existing_ids]
+    to_delete = sorted(known - set(chunks))
+    stats = {"chunks": len(chunks), "added": len(to_add), "deleted": len(to_delete),
+             "unchanged": len(chunks) - len(to_add)}
+    if dry_run or not (to_add or to_delete):
+        return stats
+
+    client_ai = make_client() if to_add else None
+    for start in range(0, len(to_add), KB_EMBED_BATCH):
+        batch = to_add[start:start + KB_EMBED_BATCH]
+        texts = [chunks[i][0].replace("\n", " ") for i in batch]
+        response = client_ai.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+        collection.upsert(
+            ids=batch,
+            embeddings=[item.embedding for item in sorted(response.data, key=lambda item: item.index)],
+            documents=[chunks[i][0] for i in batch],
+            metadatas=[chunks[i][1] for i in batch],
+        )
+        logging.info(f"sync_kb: добавлено {start + len(batch)}/{len(to_add)}")
+
+    if to_delete:
+        collection.delete(ids=to_delete)
+
+    # Новая версия базы: бот по ней сбросит кэш ответов и перестроит индекс в памяти
+    all_ids = sorted(set(collection.get(include=[])["ids"]))
+    kb_version = hashlib.sha256("\n".join(all_ids).encode("utf-8")).hexdigest()[:16]
+    metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    collection.modify(metadata={**metadata, "kb_version": kb_version})
+    stats["kb_version"] = kb_version
+    return stats
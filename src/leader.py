@@ -0,0 +1,102 @@
+import os
+import socket
+import asyncio
+import logging
+import asyncpg
+
+from src.storage import DB_CONNECT_TIMEOUT, DB_COMMAND_TIMEOUT
+
+# ================== НАСТРОЙКИ ==================
+# 1 — несколько экземпляров бота: фоновые задачи выполняет только лидер
+MULTI_INSTANCE = os.getenv("MULTI_INSTANCE", "0") == "1"
+LEADER_LOCK_ID = int(os.getenv("LEADER_LOCK_ID", "7301150"))  # ключ pg_advisory_lock, общий для всех экземпляров
+LEADER_POLL_SECONDS = float(os.getenv("LEADER_POLL_SECONDS", "10"))
+INSTANCE_ID = os.getenv("RENDER_INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaderElection:
+    """
+    Выбор лидера через сессионный advisory lock Postgres.
+    Блокировка живет, пока открыто отдельное (не из пула) соединение: если лидер упал
+    или потерял связь с базой, Postgres снимает ее сам, и замок забирает другой экземпляр
+    при следующей проверке. on_elected / on_demoted запускают и останавливают фоновые задачи.
+    Без MULTI_INSTANCE экземпляр сразу считается лидером.
+    """
+
+    def __init__(self, dsn, on_elected, on_demoted, enabled: bool = MULTI_INSTANCE,
+                 lock_id: int = LEADER_LOCK_ID, interval: float = LEADER_POLL_SECONDS):
+        self.dsn = dsn
+        self.on_elected = on_elected  # async, без аргументов
+        self.on_demoted = on_demoted
+        self.enabled = enabled
+        self.lock_id = lock_id
+        self.interval = interval
+        self.instance_id = INSTANCE_ID
+        self.is_leader = False
+        self._conn = None
+        self._task = None
+
+    async def start(self):
+        if not self.enabled:
+            await self._promote()
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+        await self._disconnect()
+
+    async def _run(self):
+        while True:
+            try:
+                if self._conn is None or self._conn.is_closed():
+                    if self.is_leader:
+                        # Соединение с замком потеряно — замок уже мог забрать другой экземпляр
+                        await self._demote()
+                    self._conn = await asyncpg.connect(dsn=self.dsn, timeout=DB_CONNECT_TIMEOUT,
+                                                       command_timeout=DB_COMMAND_TIMEOUT)
+                if self.is_leader:
+                    await self._conn.fetchval("SELECT 1")
+                elif await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", self.lock_id):
+                    await self._promote()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Выбор лидера ({self.instance_id}): {e}")
+                if self.is_leader:
+                    await self._demote()
+                await self._disconnect()
+            await asyncio.sleep(self.interval)
+
+    async def _promote(self):
+        self.is_leader = True
+        logging.info(f"Экземпляр {self.instance_id} стал лидером")
+        await self.on_elected()
+
+    async def _demote(self):
+        self.is_leader = False
+        logging.warning(f"Экземпляр {self.instance_id} больше не лидер")
+        try:
+            await self.on_demoted()
+        except Exception as e:
+            logging.error(f"Остановка фоновых задач: {e}")
+
+    async def _disconnect(self):
+        if self._conn is not None:
+            try:
+                await self._conn.close(timeout=DB_COMMAND_TIMEOUT)
+            except Exception:
+                self._conn.terminate()
+            self._conn = None
+
+    def stats(self):
+        return {"instance_id": self.instance_id, "leader": self.is_leader, "multi_instance": self.enabled}
@@ -0,0 +1,92 @@
+import time
+import asyncio
+from functools import wraps
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Внешние вызовы: от миллисекунд (Postgres) до десятков секунд (GPT, Google при повторах)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+EXTERNAL_CALL_SECONDS = Histogram(
+    "bot_external_call_seconds", "Длительность внешних вызовов",
+    ["service", "operation"], buckets=LATENCY_BUCKETS,
+)
+EXTERNAL_CALL_ERRORS = Counter(
+    "bot_external_call_errors_total", "Ошибки внешних вызовов", ["service", "operation"],
+)
+WEBHOOK_SECONDS = Histogram(
+    "bot_webhook_seconds", "Обработка запроса /webhook (в режиме queue — только прием)",
+    ["mode"], buckets=LATENCY_BUCKETS,
+)
+WEBHOOK_ERRORS = Counter("bot_webhook_errors_total", "Ошибки /webhook", ["mode"])
+FEED_UPDATE_SECONDS = Histogram(
+    "bot_feed_update_seconds", "Обработка апдейта aiogram (dp.feed_update)", buckets=LATENCY_BUCKETS,
+)
+FEED_UPDATE_ERRORS = Counter("bot_feed_update_errors_total", "Ошибки dp.feed_update")
+EVENT_LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "Насколько опаздывает event loop")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Длина внутренних очередей", ["queue"])
+
+
+def record(service: str, operation: str, seconds: float, error: bool = False):
+    EXTERNAL_CALL_SECONDS.labels(service, operation).observe(seconds)
+    if error:
+        EXTERNAL_CALL_ERRORS.labels(service, operation).inc()
+
+
+@contextmanager
+def observe(service: str, operation: str):
+    """with observe("postgres", "get_history"): ... — длительность и ошибка (исключение пробрасывается)"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # Отмена задачи — не ошибка сервиса
+        record(service, operation, time.perf_counter() - started, error=not isinstance(e, asyncio.CancelledError))
+        raise
+    record(service, operation, time.perf_counter() - started)
+
+
+def timed(service: str, operation: str):
+    """Декоратор для синхронных функций, которые выполняются в потоках (Chroma, gspread, Notion)"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe(service, operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_queue_depths(depths: dict):
+    for name, depth in depths.items():
+        QUEUE_DEPTH.labels(name).set(depth)
+
+
+def render():
+    """Тело и Content-Type ответа /metrics"""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class EventLoopMonitor:
+    """Раз в interval секунд засекает, на сколько позже положенного проснулась задача"""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.set(max(0.0, loop.time() - started - self.interval))
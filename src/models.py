@@ -0,0 +1,3 @@
+# Модели OpenAI — отдельно от brain, чтобы офлайн-скрипты (sync_kb) не тянули весь рантайм бота
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHAT_MODEL = "gpt-4o-mini"
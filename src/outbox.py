@@ -0,0 +1,188 @@
+import os
+import asyncio
+import logging
+
+# ================== НАСТРОЙКИ ==================
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_RETRY_BASE_SECONDS = int(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "30"))
+OUTBOX_KEEP_DAYS = int(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+OUTBOX_MARK_RETRIES = 3  # попытки отметить доставленное событие, прежде чем сдаться
+
+
+class Outbox:
+    """
+    Надежная очередь побочных эффектов (Sheets, Notion, уведомления) в Postgres.
+    Хендлеры пишут намерения одной транзакцией, диспетчер разбирает их пачками
+    и повторяет упавшие — рестарт инстанса больше не теряет лиды.
+    Доставленное событие отмечается done сразу после успеха интеграции, поэтому повтор
+    пачки (ошибка записи итогов, падение инстанса) не отправляет его второй раз.
+    События с одним ключом очереди (лид + семейство интеграций, например таблицы) доставляются по порядку:
+    пока более раннее ждет повтора, поздние не берем. Остальные интеграции лида от него не зависят.
+    """
+
+    def __init__(self, db, pipeline):
+        self.db = db
+        self.pipeline = pipeline
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._closing = False
+
+    async def init(self):
+        async with self.db.acquire() as conn:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                                      id BIGSERIAL PRIMARY KEY,
+                                      idempotency_key TEXT NOT NULL UNIQUE,
+                                      kind TEXT NOT NULL,
+                                      payload JSONB NOT NULL,
+                                      status TEXT NOT NULL DEFAULT 'pending',
+                                      attempts INT NOT NULL DEFAULT 0,
+                                      last_error TEXT,
+                                      next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                                      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                                      done_at TIMESTAMPTZ)''')
+            await conn.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS ordering_key TEXT")
+            await conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending_idx "
+                               "ON outbox (next_attempt_at) WHERE status = 'pending'")
+            await conn.execute("CREATE INDEX IF NOT EXISTS outbox_ordering_pending_idx "
+                               "ON outbox (ordering_key, id) WHERE status = 'pending'")
+
+    # --- API для хендлеров ---
+
+    async def write(self, events: list, supersedes=()):
+        """
+        events: [(idempotency_key, kind, payload, ordering_key)]. Всё пишется одной транзакцией;
+        повторное событие с тем же ключом идемпотентности игнорируется.
+        supersedes — виды событий, которые новые события с теми же ключами очереди делают ненужными:
+        их ожидающие записи закрываются статусом superseded и больше не доставляются.
+        """
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                if supersedes:
+                    await conn.execute('''UPDATE outbox SET status = 'superseded', done_at = now()
+                                          WHERE status = 'pending' AND ordering_key = ANY($1::text[])
+                                            AND kind = ANY($2::text[])''',
+                                       list({key for _, _, _, key in events if key}), list(supersedes))
+                await conn.executemany('''INSERT INTO outbox (idempotency_key, kind, payload, ordering_key)
+                                          VALUES ($1, $2, $3, $4)
+                                          ON CONFLICT (idempotency_key) DO NOTHING''', events)
+        self._wakeup.set()
+
+    # --- Диспетчер ---
+
+    def start(self):
+        if self._worker is None:
+            self._closing = False
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Новые пачки не забираем; текущую доставляем до конца и отмечаем в базе, затем выходим"""
+        if self._worker is not None:
+            self._closing = True
+            self._wakeup.set()
+            # shield: отмена вызывающего (остановка лидера) не должна оборвать доставку пачки
+            await asyncio.shield(self._worker)
+            self._worker = None
+
+    async def pending_count(self):
+        async with self.db.acquire() as conn:
+            return await conn.fetchval("SELECT count(*) FROM outbox WHERE status = 'pending'")
+
+    async def _claim(self):
+        """
+        Забираем пачку под аренду: другой инстанс ее не возьмет, после падения она вернется в очередь.
+        Событие пропускаем, если более раннее событие с тем же ключом очереди ждет повтора или уже в работе.
+        """
+        async with self.db.acquire() as conn:
+            return await conn.fetch('''UPDATE outbox SET next_attempt_at = now() + make_interval(secs => $2::int)
+                                       WHERE id IN (SELECT o.id FROM outbox o
+                                                    WHERE o.status = 'pending' AND o.next_attempt_at <= now()
+                                                      AND NOT EXISTS (
+                                                          SELECT 1 FROM outbox e
+                                                          WHERE e.ordering_key = o.ordering_key AND e.id < o.id
+                                                            AND e.status = 'pending' AND e.next_attempt_at > now())
+                                                    ORDER BY o.id LIMIT $1
+                                                    FOR UPDATE SKIP LOCKED)
+                                       RETURNING id, kind, payload, attempts''',
+                                    OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+
+    async def _mark_done(self, row_id):
+        """Событие доставлено — отмечаем сразу, чтобы повтор пачки его не задублировал"""
+        for attempt in range(1, OUTBOX_MARK_RETRIES + 1):
+            try:
+                async with self.db.acquire() as conn:
+                    await conn.execute("UPDATE outbox SET status = 'done', done_at = now() "
+                                       "WHERE id = $1 AND status = 'pending'", row_id)
+                return True
+            except Exception as e:
+                logging.error(f"Outbox: не удалось отметить событие {row_id} доставленным: {e}")
+                if attempt < OUTBOX_MARK_RETRIES:
+                    await asyncio.sleep(attempt)
+        return False
+
+    async def _complete(self, rows, results, marked):
+        done, retry, failed = [], [], []
+        for row, r in zip(rows, results):
+            attempts = row["attempts"] + 1
+            if r["ok"]:
+                if row["id"] not in marked:
+                    done.append((row["id"],))
+            elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                failed.append((row["id"], attempts, r["error"]))
+            else:
+                delay = OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                retry.append((row["id"], attempts, r["error"], delay))
+
+        # status = 'pending': событие могло быть закрыто как superseded, пока доставлялось
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                if done:
+                    await conn.executemany("UPDATE outbox SET status = 'done', done_at = now() "
+                                           "WHERE id = $1 AND status = 'pending'", done)
+                if retry:
+                    await conn.executemany('''UPDATE outbox SET attempts = $2, last_error = $3,
+                                              next_attempt_at = now() + make_interval(secs => $4::int)
+                                              WHERE id = $1 AND status = 'pending'
+                                           ''', retry)
+                if failed:
+                    await conn.executemany("UPDATE outbox SET status = 'failed', attempts = $2, last_error = $3 "
+                                           "WHERE id = $1 AND status = 'pending'", failed)
+        for row_id, attempts, error in failed:
+            logging.error(f"Outbox: событие {row_id} не доставлено после {attempts} попыток: {error}")
+
+    async def _dispatch(self, rows):
+        marked = set()
+
+        async def on_success(i):
+            if await self._mark_done(rows[i]["id"]):
+                marked.add(rows[i]["id"])
+
+        # ORDER BY id сохраняет порядок событий одного лида внутри пачки
+        results = await self.pipeline.finalize([(row["kind"], row["payload"]) for row in rows], on_success)
+        await self._complete(rows, results, marked)
+
+    async def _run(self):
+        while not self._closing:
+            self._wakeup.clear()
+            try:
+                rows = await self._claim()
+                if rows:
+                    await self._dispatch(rows)
+                    continue
+            except Exception as e:
+                logging.error(f"Outbox dispatcher error: {e}")
+
+            if self._closing:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def purge(self):
+        """Чистим доставленные и замененные события старше OUTBOX_KEEP_DAYS"""
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM outbox WHERE status IN ('done', 'superseded') "
+                               "AND done_at < now() - make_interval(days => $1)", OUTBOX_KEEP_DAYS)
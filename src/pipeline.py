@@ -0,0 +1,77 @@
+import os
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+# ================== НАСТРОЙКИ ==================
+INTEGRATION_THREADS = int(os.getenv("INTEGRATION_THREADS", "4"))
+SINK_MAX_RETRIES = int(os.getenv("SINK_MAX_RETRIES", "3"))
+SINK_RETRY_DELAY = float(os.getenv("SINK_RETRY_DELAY", "2"))
+
+
+class LeadPipeline:
+    """
+    Финализация лида: Sheets, Notion, уведомление админа и т.д. запускаются параллельно.
+    У каждой интеграции свои повторы и своя запись об успехе/ошибке,
+    поэтому медленная интеграция не задерживает остальные.
+    """
+
+    def __init__(self, max_workers: int = INTEGRATION_THREADS):
+        # Блокирующие SDK (notion_client и т.п.) — только через этот ограниченный пул
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="integrations")
+        self.sinks = {}   # name -> (async func(data) -> bool, retries)
+
+    def add_sink(self, name: str, func, retries: int = SINK_MAX_RETRIES):
+        self.sinks[name] = (func, retries)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def run_sink(self, name: str, data: dict):
+        """Одна интеграция с повторами. Возвращает запись {sink, ok, attempts, error}"""
+        record = {"sink": name, "ok": False, "attempts": 0, "error": None}
+        if name not in self.sinks:
+            record["error"] = "unknown sink"
+            return record
+        func, retries = self.sinks[name]
+        for attempt in range(1, retries + 1):
+            record["attempts"] = attempt
+            try:
+                if await func(data):
+                    record["ok"] = True
+                    record["error"] = None
+                    break
+                record["error"] = "returned False"
+            except Exception as e:
+                record["error"] = str(e)
+            if attempt < retries:
+                await asyncio.sleep(SINK_RETRY_DELAY * attempt)
+        return record
+
+    async def finalize(self, items: list, on_success=None):
+        """
+        Прогоняет пачку (sink, data) через интеграции одновременно.
+        Возвращает записи в том же порядке; порядок запуска тоже сохраняется,
+        поэтому операции одной таблицы попадают в очередь SheetSink по порядку.
+        on_success(i) — async, вызывается сразу после успешной доставки i-го элемента, не дожидаясь пачки.
+        """
+        async def run(i, name, data):
+            record = await self.run_sink(name, data)
+            if record["ok"] and on_success is not None:
+                await on_success(i)
+            return record
+
+        results = await asyncio.gather(*(run(i, name, data) for i, (name, data) in enumerate(items)))
+        for (_, data), r in zip(items, results):
+            tid = data.get("telegram_id")
+            if r["ok"]:
+                logging.info(f"Лид {tid}: {r['sink']} — ок (попыток: {r['attempts']})")
+            else:
+                logging.error(f"Лид {tid}: {r['sink']} — ошибка после {r['attempts']} попыток: {r['error']}")
+        return results
+
+    async def close(self):
+        # Ждем незавершенные вызовы SDK в отдельном потоке, чтобы не блокировать event loop
+        await asyncio.to_thread(self.executor.shutdown, wait=True)
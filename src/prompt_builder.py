@@ -0,0 +1,109 @@
+import os
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем приблизительно
+    tiktoken = None
+
+# ================== НАСТРОЙКИ ==================
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))         # весь промпт, без ответа
+PROMPT_MAX_MESSAGE_TOKENS = int(os.getenv("PROMPT_MAX_MESSAGE_TOKENS", "600"))  # одно сообщение истории
+PROMPT_MIN_HISTORY_MESSAGES = int(os.getenv("PROMPT_MIN_HISTORY_MESSAGES", "2"))
+MESSAGE_OVERHEAD_TOKENS = 4  # служебные токены на каждое сообщение chat-формата
+
+
+class TokenCounter:
+    """Подсчет токенов локальным токенизатором модели (tiktoken), иначе — оценка по длине"""
+
+    def __init__(self, model: str):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(self, text: str):
+        if not text:
+            return 0
+        if self.encoding is None:
+            return len(text) // 3 + 1  # кириллица ~ 3 символа на токен
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message: dict):
+        return self.count(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+    def truncate(self, text: str, max_tokens: int):
+        if self.count(text) <= max_tokens:
+            return text
+        if self.encoding is None:
+            return text[:max_tokens * 3] + "…"
+        return self.encoding.decode(self.encoding.encode(text)[:max_tokens]) + "…"
+
+
+class PromptBuilder:
+    """
+    Укладывает контекст из базы и историю переписки в бюджет токенов.
+    При переполнении сначала выбрасываются самые старые реплики (пока их больше минимума),
+    затем наименее релевантные куски контекста, кроме самого релевантного, затем остальные реплики
+    и сводка. Самый релевантный кусок уходит последним — без него ответ не опирается на базу.
+    Если реплики выброшены, а есть сводка ранней переписки — она идет вместо них.
+    """
+
+    def __init__(self, counter: TokenCounter, budget: int = PROMPT_TOKEN_BUDGET,
+                 max_message_tokens: int = PROMPT_MAX_MESSAGE_TOKENS,
+                 min_history: int = PROMPT_MIN_HISTORY_MESSAGES):
+        self.counter = counter
+        self.budget = budget
+        self.max_message_tokens = max_message_tokens
+        self.min_history = min_history
+
+    def fit(self, fixed_tokens: int, chunks: list, history: list, summary: str = None):
+        """
+        fixed_tokens — то, что войдет в любом случае (системный промпт без контекста и вопрос).
+        chunks — куски контекста по убыванию релевантности.
+        Возвращает (chunks, history, summary, usage).
+        """
+        # Длинные вставки в истории обрезаем, а не тащим целиком
+        history = [
+            {**m, "content": self.counter.truncate(m.get("content", ""), self.max_message_tokens)}
+            for m in history
+        ]
+        chunk_tokens = [self.counter.count(c) + 1 for c in chunks]
+        history_tokens = [self.counter.count_message(m) for m in history]
+        summary_tokens = self.counter.count_message({"content": summary}) if summary else 0
+
+        chunks_kept, history_kept = len(chunks), len(history)
+
+        def total():
+            used = fixed_tokens + sum(chunk_tokens[:chunks_kept]) + sum(history_tokens[len(history) - history_kept:])
+            if summary:
+                used += summary_tokens
+            return used
+
+        while total() > self.budget:
+            if history_kept > self.min_history:
+                history_kept -= 1
+            elif chunks_kept > 1:
+                chunks_kept -= 1
+            elif history_kept > 0:
+                history_kept -= 1
+            elif summary:
+                summary = None
+            elif chunks_kept > 0:
+                chunks_kept -= 1
+            else:
+                break
+
+        kept_history = history[len(history) - history_kept:]
+        usage = {
+            "budget": self.budget,
+            "fixed": fixed_tokens,
+            "context": sum(chunk_tokens[:chunks_kept]),
+            "history": sum(history_tokens[len(history) - history_kept:]),
+            "summary": summary_tokens if summary else 0,
+            "total": total(),
+            "dropped_chunks": len(chunks) - chunks_kept,
+            "dropped_messages": len(history) - history_kept,
+        }
+        return chunks[:chunks_kept], kept_history, summary, usage
@@ -0,0 +1,191 @@
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+# Не удалось забрать касания из Postgres — повторяем через столько секунд, ничего не отправляя
+REMINDER_CLAIM_RETRY_SECONDS = 30
+
+
+class ReminderStage:
+    """Одно касание дожатия: через delay после /start, актуально до expire_after"""
+
+    def __init__(self, code: str, delay: timedelta, expire_after: timedelta):
+        self.code = code
+        self.delay = delay
+        self.expire_after = expire_after
+
+
+class ReminderScheduler:
+    """
+    Дожатие брошенных анкет без опроса таблицы.
+    Ожидающие касания лежат в Postgres (reminders, индекс по due_at) и в min-heap в памяти;
+    фоновая задача спит ровно до ближайшего due_at.
+    Воркер запускается только у лидера; остальные экземпляры лишь пишут в таблицу.
+    """
+
+    def __init__(self, db, stages: list, send):
+        self.db = db
+        self.stages = {stage.code: stage for stage in stages}
+        self.send = send  # async send([(telegram_id, stage_code)]) — вся пачка наступивших касаний
+        self._heap = []      # (due_at_ts, telegram_id, stage_code)
+        self._pending = {}   # (telegram_id, stage_code) -> (due_at_ts, expires_at_ts)
+        self._wakeup = asyncio.Event()
+        self._worker = None
+
+    async def init(self):
+        async with self.db.acquire() as conn:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS reminders (
+                                      telegram_id TEXT NOT NULL,
+                                      stage TEXT NOT NULL,
+                                      due_at TIMESTAMPTZ NOT NULL,
+                                      expires_at TIMESTAMPTZ NOT NULL,
+                                      PRIMARY KEY (telegram_id, stage))''')
+            await conn.execute("CREATE INDEX IF NOT EXISTS reminders_due_at_idx ON reminders (due_at)")
+            # Отметки разовых переносов из внешних источников (например, из leads_unconfirmed)
+            await conn.execute('''CREATE TABLE IF NOT EXISTS reminder_imports (
+                                      source TEXT PRIMARY KEY,
+                                      imported INTEGER NOT NULL DEFAULT 0,
+                                      imported_at TIMESTAMPTZ NOT NULL DEFAULT now())''')
+
+    async def load(self):
+        """
+        Перечитывает очередь из Postgres: при старте воркера и по расписанию у лидера
+        (касания, поставленные и отмененные другими экземплярами, есть только в таблице)
+        """
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT telegram_id, stage, due_at, expires_at FROM reminders ORDER BY due_at")
+        self._heap = []
+        self._pending = {}
+        for row in rows:
+            self._push(row["telegram_id"], row["stage"], row["due_at"].timestamp(), row["expires_at"].timestamp())
+        self._wakeup.set()
+        logging.info(f"Дожатие: загружено {len(rows)} ожидающих касаний")
+        return len(rows)
+
+    # --- API для хендлеров ---
+
+    async def schedule(self, telegram_id, created_at: datetime, skip_stages=()):
+        """Ставит все касания для нового лида (повторный /start переставляет их заново)"""
+        tid = str(telegram_id)
+        rows = []
+        for stage in self.stages.values():
+            if stage.code in skip_stages:
+                continue
+            due_at = created_at + stage.delay
+            expires_at = created_at + stage.expire_after
+            rows.append((tid, stage.code, due_at, expires_at))
+            if self._worker is not None:
+                self._push(tid, stage.code, due_at.timestamp(), expires_at.timestamp())
+        if not rows:
+            return
+        async with self.db.acquire() as conn:
+            await conn.executemany('''INSERT INTO reminders (telegram_id, stage, due_at, expires_at)
+                                      VALUES ($1, $2, $3, $4)
+                                      ON CONFLICT (telegram_id, stage)
+                                      DO UPDATE SET due_at = EXCLUDED.due_at, expires_at = EXCLUDED.expires_at''',
+                                   rows)
+
+    async def cancel(self, telegram_id):
+        """Лид подтвержден — больше не напоминаем"""
+        tid = str(telegram_id)
+        for code in self.stages:
+            self._pending.pop((tid, code), None)
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM reminders WHERE telegram_id = $1", tid)
+
+    async def is_empty(self):
+        async with self.db.acquire() as conn:
+            return not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM reminders)")
+
+    async def is_imported(self, source: str):
+        async with self.db.acquire() as conn:
+            return await conn.fetchval("SELECT EXISTS (SELECT 1 FROM reminder_imports WHERE source = $1)", source)
+
+    async def mark_imported(self, source: str, count: int = 0):
+        async with self.db.acquire() as conn:
+            await conn.execute('''INSERT INTO reminder_imports (source, imported) VALUES ($1, $2)
+                                  ON CONFLICT (source) DO NOTHING''', source, count)
+
+    def _push(self, tid, code, due_ts, expires_ts):
+        self._pending[(tid, code)] = (due_ts, expires_ts)
+        heapq.heappush(self._heap, (due_ts, tid, code))
+        if self._heap[0][0] == due_ts:
+            self._wakeup.set()  # новое касание раньше, чем то, которого мы ждем
+
+    # --- Фоновая задача ---
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        self._heap = []
+        self._pending = {}
+
+    def qsize(self):
+        return len(self._pending)
+
+    def _pop_due(self, now_ts):
+        """Снимает с кучи все наступившие касания; устаревшие записи кучи пропускаются"""
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            due_ts, tid, code = heapq.heappop(self._heap)
+            pending = self._pending.get((tid, code))
+            if pending is None or pending[0] != due_ts:
+                continue  # касание отменено или переставлено
+            del self._pending[(tid, code)]
+            due.append((tid, code, pending[1]))
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now_ts = datetime.now(timezone.utc).timestamp()
+            due = self._pop_due(now_ts)
+            if due:
+                await self._fire(due, now_ts)
+                continue
+
+            timeout = self._heap[0][0] - now_ts if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, due, now_ts):
+        # Забираем касания из таблицы: отправляем только то, что там еще было и уже наступило
+        # (другой экземпляр мог отменить анкету или переставить касание повторным /start)
+        try:
+            async with self.db.acquire() as conn:
+                rows = await conn.fetch('''DELETE FROM reminders r
+                                           USING unnest($1::text[], $2::text[]) AS d(telegram_id, stage)
+                                           WHERE r.telegram_id = d.telegram_id AND r.stage = d.stage
+                                             AND r.due_at <= now()
+                                           RETURNING r.telegram_id, r.stage''',
+                                        [tid for tid, _, _ in due], [code for _, code, _ in due])
+        except Exception as e:
+            # Строки остались в reminders: без отметки в базе отправка задублировалась бы после перезагрузки
+            logging.error(f"Дожатие: ошибка удаления из reminders, повтор через {REMINDER_CLAIM_RETRY_SECONDS} c: {e}")
+            for tid, code, expires_ts in due:
+                if (tid, code) not in self._pending:
+                    self._push(tid, code, now_ts + REMINDER_CLAIM_RETRY_SECONDS, expires_ts)
+            return
+        claimed = {(row["telegram_id"], row["stage"]) for row in rows}
+        due = [item for item in due if (item[0], item[1]) in claimed]
+
+        batch = []
+        for tid, code, expires_ts in due:
+            if now_ts >= expires_ts:
+                logging.info(f"Дожатие {code} для {tid} устарело, пропускаем")
+                continue
+            batch.append((tid, code))
+        if not batch:
+            return
+        try:
+            await self.send(batch)
+        except Exception as e:
+            logging.error(f"Ошибка отправки дожатия ({len(batch)} касаний): {e}")
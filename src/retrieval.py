@@ -0,0 +1,79 @@
+import os
+import time
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+# ================== НАСТРОЙКИ ==================
+RETRIEVAL_THREADS = int(os.getenv("RETRIEVAL_THREADS", "2"))
+RETRIEVAL_MAX_PENDING = int(os.getenv("RETRIEVAL_MAX_PENDING", "8"))  # в работе + в очереди
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "2.0"))  # секунды
+
+
+class RetrievalExecutor:
+    """
+    Синхронные запросы к ChromaDB (SQLite + HNSW) — в отдельном маленьком пуле потоков.
+    Если очередь переполнена или запрос не уложился в таймаут, возвращаем None
+    и отвечаем без контекста, вместо того чтобы держать event loop.
+    """
+
+    def __init__(self, max_workers: int = RETRIEVAL_THREADS, max_pending: int = RETRIEVAL_MAX_PENDING,
+                 timeout: float = RETRIEVAL_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0   # запросы, которые еще занимают пул (включая брошенные по таймауту)
+        self.queries = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def run(self, func, *args, **kwargs):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logging.warning(f"Chroma: очередь поиска заполнена ({self.pending}), отвечаем без контекста")
+            return None
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        future = self.executor.submit(partial(func, *args, **kwargs))
+        # Место в очереди освобождается, только когда поток действительно закончил
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.warning(f"Chroma: поиск дольше {self.timeout} c, отвечаем без контекста")
+            return None
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Chroma query error: {e}")
+            return None
+
+        latency = time.perf_counter() - started
+        self.queries += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return result
+
+    def _release(self):
+        self.pending -= 1
+
+    def stats(self):
+        return {
+            "queue_depth": self.pending,
+            "queries": self.queries,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "avg_latency_ms": round(1000 * self.total_latency / self.queries, 1) if self.queries else 0.0,
+            "max_latency_ms": round(1000 * self.max_latency, 1),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
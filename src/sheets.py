@@ -0,0 +1,299 @@
+import os
+import time
+import asyncio
+import logging
+from gspread.exceptions import APIError
+from gspread.utils import rowcol_to_a1
+
+from src.metrics import observe
+
+# ================== НАСТРОЙКИ ==================
+SHEET_BATCH_SIZE = int(os.getenv("SHEET_BATCH_SIZE", "50"))
+SHEET_BATCH_WINDOW = float(os.getenv("SHEET_BATCH_WINDOW", "1.0"))  # секунды на сбор пачки
+SHEET_MAX_RETRIES = int(os.getenv("SHEET_MAX_RETRIES", "5"))
+SHEET_RETRY_BASE_DELAY = float(os.getenv("SHEET_RETRY_BASE_DELAY", "2"))
+SHEET_INDEX_RECONCILE_MINUTES = int(os.getenv("SHEET_INDEX_RECONCILE_MINUTES", "30"))
+
+# Квота Google (429) и временные ошибки сервера — повторяем с паузой
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+LAST_COLUMN = "O"  # leads_unconfirmed: 15 колонок A-O
+
+
+class SheetRowIndex:
+    """
+    Локальный индекс telegram_id -> номер строки в leads_unconfirmed.
+    Загружается один раз, дальше поддерживается вставками и удалениями воркера.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.next_free_row = 1
+        self.loaded = False
+
+    def load(self, col_a_values):
+        rows = {}
+        for i, value in enumerate(col_a_values):
+            rows.setdefault(value, i + 1)  # как list.index — первое совпадение
+        self.rows = rows
+        self.next_free_row = len(col_a_values) + 1
+        self.loaded = True
+
+    def get(self, tid):
+        return self.rows.get(tid)
+
+    def add(self, tid):
+        row_idx = self.next_free_row
+        self.rows.setdefault(tid, row_idx)
+        self.next_free_row += 1
+        return row_idx
+
+    def remove_row(self, row_idx):
+        """После delete_rows все строки ниже сдвигаются на одну вверх"""
+        self.rows = {tid: (r - 1 if r > row_idx else r) for tid, r in self.rows.items() if r != row_idx}
+        self.next_free_row -= 1
+
+
+class SheetSink:
+    """
+    Отложенная запись в Google Таблицы.
+    Хендлеры только кладут изменения в очередь, один воркер собирает их в пачки
+    и отправляет через batch_update / insert_rows / append_rows в отдельном потоке.
+    """
+
+    def __init__(self, main_sheet, unconfirmed_sheet):
+        self.main_sheet = main_sheet
+        self.unconfirmed_sheet = unconfirmed_sheet
+        self.index = SheetRowIndex()
+        # Строки, уже добавленные в leads_main: повтор finalize (не прошло удаление из leads_unconfirmed,
+        # outbox не успел отметить доставку) не должен дублировать лид
+        self._main_written = set()
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    # --- API для хендлеров (не ждут Google) ---
+
+    def upsert_unconfirmed(self, tid, row: list):
+        """Обновить строку лида в leads_unconfirmed или добавить новую"""
+        return self._enqueue(("upsert", str(tid), row))
+
+    def finalize(self, tid, row_main: list):
+        """Перенести лид в leads_main и удалить его из leads_unconfirmed"""
+        return self._enqueue(("finalize", str(tid), row_main))
+
+    def update_status(self, tid, col_idx: int, value):
+        """Поменять одну ячейку (статус дожатия) в строке лида"""
+        return self._enqueue(("status", str(tid), (col_idx, value)))
+
+    def update_statuses(self, items: list):
+        """Статусы целой рассылки [(tid, col_idx, value)] — одной операцией, значит, одним batch_update"""
+        return self._enqueue(("statuses", None, [(str(tid), col_idx, value) for tid, col_idx, value in items]))
+
+    async def reconcile(self):
+        """Сверка индекса с таблицей (по расписанию). Выполняется воркером между пачками"""
+        return self._enqueue(("reload", None, None))
+
+    def _enqueue(self, op):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        return future
+
+    # --- Воркер ---
+
+    def start(self):
+        if self._worker is None:
+            self._enqueue(("reload", None, None))  # индекс грузим один раз при старте
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Дописываем всё, что осталось в очереди, и останавливаем воркер"""
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        self._worker = None
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + SHEET_BATCH_WINDOW
+            while len(batch) < SHEET_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            ops = [op for op, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self._apply_batch, ops)
+            except Exception as e:
+                logging.error(f"Критическая ошибка Google Sheets (пачка из {len(ops)}): {e}")
+                self.index.loaded = False
+                results = [False] * len(ops)
+
+            for (_, future), ok in zip(batch, results):
+                if not future.done():
+                    future.set_result(ok)
+                self._queue.task_done()
+
+    # --- Применение пачки (выполняется в потоке) ---
+
+    def _reload_index(self):
+        col_a_values = self._call(self.unconfirmed_sheet.col_values, 1)
+        old_rows, was_loaded = self.index.rows, self.index.loaded
+        self.index.load(col_a_values)
+        if was_loaded and old_rows != self.index.rows:
+            drift = len(set(old_rows.items()) ^ set(self.index.rows.items()))
+            logging.warning(f"Google Sheets: индекс leads_unconfirmed расходился с таблицей ({drift} записей), обновлен")
+
+    def _apply_batch(self, ops):
+        """
+        Применяет пачку и возвращает успех каждой операции: False только у тех,
+        чей вызов к Google (batch_update / insert_rows / append_rows / delete_rows) не прошел.
+        """
+        # Пачка статусов рассылки разворачивается в обычные status-операции; origins — номер исходной
+        origins, expanded = [], []
+        for i, op in enumerate(ops):
+            items = [("status", tid, (col_idx, value)) for tid, col_idx, value in op[2]] if op[0] == "statuses" else [op]
+            origins += [i] * len(items)
+            expanded += items
+        if not self.index.loaded or any(kind == "reload" for kind, _, _ in expanded):
+            self._reload_index()
+        rows = dict(self.index.rows)
+        next_free_row = self.index.next_free_row
+
+        full_rows = {}    # номер строки -> новая строка целиком
+        cells = {}        # (строка, колонка) -> значение
+        appends = {}      # tid -> строка, которой еще нет в таблице
+        deletes = set()   # номера строк на удаление
+        main_rows = []    # строки для leads_main
+        finalized = {}    # tid -> вызовы, от которых зависит перенос лида
+
+        for kind, tid, payload in expanded:
+            if kind == "reload":
+                continue
+
+            if kind == "upsert":
+                if tid in appends:
+                    appends[tid] = list(payload)
+                elif tid in rows:
+                    row_idx = rows[tid]
+                    full_rows[row_idx] = list(payload)
+                    for key in [k for k in cells if k[0] == row_idx]:
+                        del cells[key]
+                else:
+                    appends[tid] = list(payload)
+
+            elif kind == "finalize":
+                needs = finalized.setdefault(tid, set())
+                if tuple(payload) not in self._main_written:
+                    main_rows.append(payload)
+                    needs.add("main")
+                if tid in appends:
+                    del appends[tid]
+                elif tid in rows:
+                    row_idx = rows.pop(tid)
+                    deletes.add(row_idx)
+                    needs.add("delete")
+                    full_rows.pop(row_idx, None)
+                    for key in [k for k in cells if k[0] == row_idx]:
+                        del cells[key]
+
+            elif kind == "status":
+                col_idx, value = payload
+                target_row = appends.get(tid)
+                if target_row is None and tid in rows:
+                    target_row = full_rows.get(rows[tid])
+                if target_row is not None:
+                    target_row.extend([""] * (col_idx - len(target_row)))
+                    target_row[col_idx - 1] = value
+                elif tid in rows:
+                    cells[(rows[tid], col_idx)] = value
+
+        failed = set()  # вызовы, которые не прошли; остальные шаги все равно выполняем
+
+        # 1. Все обновления существующих строк — одним batch_update
+        data = [{"range": f"A{r}:{LAST_COLUMN}{r}", "values": [row]} for r, row in full_rows.items()]
+        data += [{"range": rowcol_to_a1(r, c), "values": [[v]]} for (r, c), v in cells.items()]
+        if data:
+            self._step(failed, "update", self.unconfirmed_sheet.batch_update, data)
+
+        # 2. Новые лиды — одной вставкой в конец (как раньше insert_row в len+1)
+        if appends and self._step(failed, "append", self.unconfirmed_sheet.insert_rows,
+                                  list(appends.values()), row=next_free_row):
+            for tid in appends:
+                self.index.add(tid)
+
+        # 3. Подтвержденные лиды — в leads_main одним append_rows
+        if main_rows and self._step(failed, "main", self.main_sheet.append_rows,
+                                    main_rows, value_input_option="USER_ENTERED"):
+            self._main_written.update(tuple(row) for row in main_rows)
+
+        # 4. Удаляем снизу вверх, соседние строки — одним диапазоном; строки ниже сдвигаются
+        for start, end in _row_ranges(deletes):
+            if not self._step(failed, "delete", self.unconfirmed_sheet.delete_rows, start, end):
+                break
+            for row_idx in range(end, start - 1, -1):
+                self.index.remove_row(row_idx)
+
+        def needs(kind, tid):
+            if kind == "reload":
+                return set()
+            if tid in finalized:
+                return finalized[tid]  # правки лида, перенесенного в этой же пачке, зависят от переноса
+            if tid in appends:
+                return {"append"}
+            return {"update"} if tid in rows else set()
+
+        results = [True] * len(ops)
+        for i, (kind, tid, _) in zip(origins, expanded):
+            if needs(kind, tid) & failed:
+                results[i] = False
+
+        if data or appends or main_rows or deletes:
+            logging.info(f"Google Sheets: обновлено {len(full_rows) + len(cells)}, добавлено {len(appends)}, "
+                         f"перенесено {len(main_rows)}, удалено {len(deletes)}"
+                         + (f", не выполнено: {', '.join(sorted(failed))}" if failed else ""))
+        return results
+
+    def _step(self, failed: set, name: str, func, *args, **kwargs):
+        """Один вызов пачки; при ошибке запоминаем его в failed, индекс перечитаем перед следующей пачкой"""
+        try:
+            self._call(func, *args, **kwargs)
+            return True
+        except Exception as e:
+            logging.error(f"Google Sheets: {func.__name__} не выполнен: {e}")
+            failed.add(name)
+            self.index.loaded = False
+            return False
+
+    @staticmethod
+    def _call(func, *args, **kwargs):
+        for attempt in range(SHEET_MAX_RETRIES + 1):
+            try:
+                with observe("gspread", func.__name__):
+                    return func(*args, **kwargs)
+            except APIError as e:
+                status = getattr(e.response, "status_code", None)
+                if status not in RETRYABLE_STATUSES or attempt == SHEET_MAX_RETRIES:
+                    raise
+                delay = SHEET_RETRY_BASE_DELAY * 2 ** attempt
+                logging.warning(f"Google Sheets {status}, повтор через {delay:.0f} c")
+                time.sleep(delay)
+
+
+def _row_ranges(row_numbers):
+    """{5, 6, 9} -> [(9, 9), (5, 6)] — диапазоны подряд идущих строк, снизу вверх"""
+    ranges = []
+    for r in sorted(row_numbers, reverse=True):
+        if ranges and ranges[-1][0] == r + 1:
+            ranges[-1] = (r, ranges[-1][1])
+        else:
+            ranges.append((r, r))
+    return ranges
@@ -0,0 +1,204 @@
+import os
+import json
+import logging
+import asyncpg
+from collections import OrderedDict
+
+from src.metrics import observe
+
+# ================== НАСТРОЙКИ ПУЛА ==================
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "5"))
+
+
+class Database:
+    """Общий пул соединений asyncpg. Создается в on_startup, закрывается при остановке."""
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+
+    async def connect(self):
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(
+            dsn=self.dsn,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_CONNECT_TIMEOUT,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            init=self._init_connection,
+        )
+        logging.info(f"Postgres: пул создан ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} соединений)")
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def acquire(self):
+        return self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+
+    @staticmethod
+    async def _init_connection(conn):
+        # JSONB отдаем и принимаем как обычные dict/list
+        await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+# ================== ИСТОРИЯ ПЕРЕПИСКИ ИИ ==================
+# Каждое сообщение — отдельная строка chat_messages: запись O(1), чтение только последних N
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "10"))
+QUESTION_COUNTER_CACHE_SIZE = int(os.getenv("QUESTION_COUNTER_CACHE_SIZE", "10000"))
+LEGACY_MIGRATION_LOCK_ID = 7301151  # ключ advisory lock для переноса chat_history
+
+
+class ChatStorage:
+    def __init__(self, db: Database, cache_counts: bool = True):
+        self.db = db
+        # user_id -> сколько вопросов задал пользователь (для лимита в AssistantBrain).
+        # С несколькими экземплярами кэш не видит чужих записей, поэтому там считаем в базе каждый раз
+        self.cache_counts = cache_counts
+        self._question_counts = OrderedDict()
+
+    async def init(self):
+        async with self.db.acquire() as conn:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS chat_messages (
+                                      user_id TEXT NOT NULL,
+                                      seq BIGSERIAL,
+                                      role TEXT NOT NULL,
+                                      content TEXT NOT NULL,
+                                      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                                      PRIMARY KEY (user_id, seq))''')
+            await conn.execute("CREATE INDEX IF NOT EXISTS chat_messages_user_role_idx "
+                               "ON chat_messages (user_id, role)")
+            # Сводка ранней переписки: сообщения до upto_seq свернуты в summary и удалены,
+            # questions — сколько вопросов было среди удаленных (для лимита)
+            await conn.execute('''CREATE TABLE IF NOT EXISTS chat_summaries (
+                                      user_id TEXT PRIMARY KEY,
+                                      summary TEXT NOT NULL,
+                                      upto_seq BIGINT NOT NULL,
+                                      questions INTEGER NOT NULL DEFAULT 0,
+                                      updated_at TIMESTAMPTZ NOT NULL DEFAULT now())''')
+            await self._migrate_legacy(conn)
+
+    async def _migrate_legacy(self, conn):
+        """
+        Один раз переносим старые JSONB-истории из chat_history в chat_messages.
+        После переноса таблица переименовывается в chat_history_migrated — это и есть отметка,
+        что перенос сделан. Экземпляры, стартующие одновременно, ждут друг друга на advisory lock.
+        """
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", LEGACY_MIGRATION_LOCK_ID)
+            if await conn.fetchval("SELECT to_regclass('chat_history')") is None:
+                return
+            moved = await conn.execute('''INSERT INTO chat_messages (user_id, role, content)
+                                          SELECT h.user_id, m.value->>'role', m.value->>'content'
+                                          FROM chat_history h,
+                                               jsonb_array_elements(h.history) WITH ORDINALITY AS m(value, ord)
+                                          WHERE jsonb_typeof(h.history) = 'array'
+                                          ORDER BY h.user_id, m.ord''')
+            await conn.execute("ALTER TABLE chat_history RENAME TO chat_history_migrated")
+        logging.info(f"Postgres: перенос chat_history -> chat_messages ({moved}), старая таблица переименована")
+
+    async def get_history(self, user_id, limit: int = CHAT_HISTORY_WINDOW):
+        """Последние limit сообщений в хронологическом порядке"""
+        try:
+            with observe("postgres", "get_history"):
+                async with self.db.acquire() as conn:
+                    rows = await conn.fetch('''SELECT role, content FROM (
+                                                   SELECT seq, role, content FROM chat_messages
+                                                   WHERE user_id = $1 ORDER BY seq DESC LIMIT $2) t
+                                               ORDER BY seq''', user_id, limit)
+            return [{"role": r["role"], "content": r["content"]} for r in rows]
+        except Exception as e:
+            logging.error(f"Postgres get_history error: {e}")
+            return []
+
+    async def get_summary(self, user_id):
+        """Сводка ранней переписки или None"""
+        try:
+            with observe("postgres", "get_summary"):
+                async with self.db.acquire() as conn:
+                    return await conn.fetchval("SELECT summary FROM chat_summaries WHERE user_id = $1", user_id)
+        except Exception as e:
+            logging.error(f"Postgres get_summary error: {e}")
+            return None
+
+    async def messages_to_summarize(self, user_id, threshold: int, keep: int):
+        """
+        Если сообщений больше threshold — все, кроме последних keep: [(seq, role, content)].
+        Иначе пустой список.
+        """
+        async with self.db.acquire() as conn:
+            total = await conn.fetchval("SELECT count(*) FROM chat_messages WHERE user_id = $1", user_id)
+            if total <= threshold:
+                return []
+            rows = await conn.fetch('''SELECT seq, role, content FROM chat_messages
+                                       WHERE user_id = $1 ORDER BY seq LIMIT $2''', user_id, total - keep)
+        return [(r["seq"], r["role"], r["content"]) for r in rows]
+
+    async def save_summary(self, user_id, summary: str, upto_seq: int):
+        """Сохраняет сводку и удаляет свернутые в нее сообщения (одной транзакцией)"""
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                removed = await conn.fetchrow('''WITH removed AS (
+                                                    DELETE FROM chat_messages
+                                                    WHERE user_id = $1 AND seq <= $2
+                                                    RETURNING role)
+                                                SELECT count(*) AS total,
+                                                       count(*) FILTER (WHERE role = 'user') AS questions
+                                                FROM removed''', user_id, upto_seq)
+                # Историю успели очистить (/start) — старая сводка уже не нужна
+                if not removed["total"]:
+                    return False
+                await conn.execute('''INSERT INTO chat_summaries (user_id, summary, upto_seq, questions)
+                                      VALUES ($1, $2, $3, $4)
+                                      ON CONFLICT (user_id) DO UPDATE
+                                      SET summary = EXCLUDED.summary,
+                                          upto_seq = EXCLUDED.upto_seq,
+                                          questions = chat_summaries.questions + EXCLUDED.questions,
+                                          updated_at = now()''', user_id, summary, upto_seq, removed["questions"])
+        return True
+
+    async def append_messages(self, user_id, messages: list):
+        with observe("postgres", "append_messages"):
+            async with self.db.acquire() as conn:
+                await conn.executemany("INSERT INTO chat_messages (user_id, role, content) VALUES ($1, $2, $3)",
+                                       [(user_id, m["role"], m["content"]) for m in messages])
+        if user_id in self._question_counts:
+            self._question_counts[user_id] += sum(1 for m in messages if m["role"] == "user")
+
+    async def clear_history(self, user_id):
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM chat_messages WHERE user_id = $1", user_id)
+            await conn.execute("DELETE FROM chat_summaries WHERE user_id = $1", user_id)
+        self._remember_count(user_id, 0)
+
+    async def count_questions(self, user_id):
+        """Счетчик вопросов пользователя: из кэша, при промахе — COUNT по индексу плюс свернутые в сводку"""
+        if self.cache_counts and user_id in self._question_counts:
+            self._question_counts.move_to_end(user_id)
+            return self._question_counts[user_id]
+        try:
+            with observe("postgres", "count_questions"):
+                async with self.db.acquire() as conn:
+                    count = await conn.fetchval('''SELECT (SELECT count(*) FROM chat_messages
+                                                         WHERE user_id = $1 AND role = 'user')
+                                                      + COALESCE((SELECT questions FROM chat_summaries
+                                                                  WHERE user_id = $1), 0)''', user_id)
+        except Exception as e:
+            logging.error(f"Postgres count_questions error: {e}")
+            return 0
+        self._remember_count(user_id, count)
+        return count
+
+    def _remember_count(self, user_id, count):
+        if not self.cache_counts:
+            return
+        self._question_counts[user_id] = count
+        self._question_counts.move_to_end(user_id)
+        while len(self._question_counts) > QUESTION_COUNTER_CACHE_SIZE:
+            self._question_counts.popitem(last=False)
@@ -0,0 +1,111 @@
+import os
+import asyncio
+import logging
+
+from src.storage import ChatStorage, CHAT_HISTORY_WINDOW
+from src.metrics import observe
+
+# ================== НАСТРОЙКИ ==================
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "30"))  # когда сворачивать
+SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", str(CHAT_HISTORY_WINDOW)))  # что оставить как есть
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_PAUSE = float(os.getenv("SUMMARY_PAUSE", "1.0"))  # секунды между задачами, чтобы не мешать ответам
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+
+SUMMARY_PROMPT = (
+    "Ты ведешь заметки консультанта PRO Unity Consult. Сожми переписку с клиентом в краткую сводку "
+    "(не больше 8 пунктов): имя клиента, его ситуация и цели, что уже обсудили и что ему предложили, "
+    "открытые вопросы. Только факты из переписки, без приветствий и оценок."
+)
+
+
+class ConversationSummarizer:
+    """
+    Фоновое сворачивание длинных историй.
+    После ответа обработчик вызывает notify(user_id); один воркер по очереди проверяет, не перевалила ли
+    история за порог, и сворачивает всё, кроме последних сообщений, в сводку chat_summaries.
+    Свернутые сообщения удаляются. На ответы пользователю это не влияет: если воркер отстал,
+    модель просто видит последнее окно и предыдущую сводку.
+    """
+
+    def __init__(self, storage: ChatStorage, client_ai, threshold: int = SUMMARY_TRIGGER_MESSAGES,
+                 keep: int = SUMMARY_KEEP_MESSAGES):
+        self.storage = storage
+        self.client_ai = client_ai
+        self.threshold = threshold
+        self.keep = keep
+        self.queue = asyncio.Queue()
+        self._queued = set()
+        self._task = None
+        self.summarized = 0
+        self.errors = 0
+
+    def notify(self, user_id):
+        """Поставить пользователя на проверку (повторные уведомления до обработки склеиваются)"""
+        if user_id not in self._queued:
+            self._queued.add(user_id)
+            self.queue.put_nowait(user_id)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    async def _run(self):
+        while True:
+            user_id = await self.queue.get()
+            self._queued.discard(user_id)
+            try:
+                await self.summarize(user_id)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Сводка переписки {user_id}: {e}")
+            finally:
+                self.queue.task_done()
+            await asyncio.sleep(SUMMARY_PAUSE)
+
+    async def summarize(self, user_id):
+        rows = await self.storage.messages_to_summarize(user_id, self.threshold, self.keep)
+        if not rows:
+            return False
+
+        previous = await self.storage.get_summary(user_id)
+        dialog = "\n".join(
+            f"{'Клиент' if role == 'user' else 'Консультант'}: {content}" for _, role, content in rows
+        )
+        if previous:
+            dialog = f"Предыдущая сводка:\n{previous}\n\nПродолжение переписки:\n{dialog}"
+
+        with observe("openai", "summary"):
+            response = await self.client_ai.chat.completions.create(
+                model=SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": dialog},
+                ],
+                temperature=0.2,
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+        summary = (response.choices[0].message.content or "").strip()
+        if not summary:
+            return False
+
+        saved = await self.storage.save_summary(user_id, summary, rows[-1][0])
+        if saved:
+            self.summarized += 1
+            logging.info(f"Сводка переписки {user_id}: свернуто {len(rows)} сообщений")
+        return saved
+
+    def stats(self):
+        return {"queue_depth": self.queue.qsize(), "summarized": self.summarized, "errors": self.errors}
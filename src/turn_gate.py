@@ -0,0 +1,108 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+# ================== НАСТРОЙКИ ==================
+TURN_DEBOUNCE_SECONDS = float(os.getenv("TURN_DEBOUNCE_SECONDS", "0.25"))  # 0 — не склеивать
+
+
+class UserTurnGate:
+    """
+    Один ход ИИ на пользователя за раз.
+    collect — склеивает пачку сообщений, присланных подряд: каждое ждет window секунд, и если за это
+    время пришло следующее, отдает ему свой текст (возвращает None). Последнее получает весь текст.
+    collect_answer — то же для запросов, которые ждут ответа (сайт): склеенные запросы получают ответ пачки.
+    lock — сериализует ходы одного пользователя, чтобы чтение и дозапись истории не перемешивались.
+    Ключи из shared_keys (общий id анонимных посетителей сайта) не склеиваются и не блокируются.
+    """
+
+    def __init__(self, window: float = TURN_DEBOUNCE_SECONDS, shared_keys=()):
+        self.window = window
+        self.shared_keys = set(shared_keys)
+        self._pending = {}  # key -> {"texts": [тексты текущей пачки], "result": Future ответа пачки}
+        self._locks = {}    # key -> [Lock, сколько корутин его ждут или держат]
+        self.turns = 0
+        self.coalesced = 0
+
+    async def collect(self, key, text: str, has_more=None):
+        """
+        Склеенный текст пачки или None, если это сообщение ушло в следующий ход.
+        has_more() — есть ли у пользователя еще не обработанные апдейты (очередь вебхука обрабатывает
+        чат по одному апдейту, поэтому следующее сообщение там ждет, а не приходит параллельно).
+        """
+        if self.window <= 0 or key in self.shared_keys:
+            self.turns += 1
+            return text
+        _, merged = await self._gather(key, text, has_more)
+        return merged
+
+    async def collect_answer(self, key, text: str, turn):
+        """
+        Для запросов, которые ждут ответа: ход делает последний запрос пачки — turn(склеенный текст),
+        а более ранние ждут и получают тот же результат (или ту же ошибку), а не пустой ответ.
+        """
+        if self.window <= 0 or key in self.shared_keys:
+            self.turns += 1
+            return await turn(text)
+
+        batch, merged = await self._gather(key, text)
+        if merged is None:
+            # shield: отключившийся посетитель не должен отменить ответ всей пачки
+            return await asyncio.shield(batch["result"])
+
+        waiting = len(batch["texts"]) > 1
+        try:
+            result = await turn(merged)
+        except asyncio.CancelledError:
+            if waiting:
+                batch["result"].set_exception(RuntimeError("ход пачки прерван"))
+            raise
+        except Exception as e:
+            if waiting:  # без ожидающих asyncio ругался бы на неполученное исключение
+                batch["result"].set_exception(e)
+            raise
+        batch["result"].set_result(result)
+        return result
+
+    async def _gather(self, key, text: str, has_more=None):
+        """Добавляет текст в пачку и ждет окно. (пачка, склеенный текст) — у последнего, иначе (пачка, None)"""
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {"texts": [], "result": asyncio.get_running_loop().create_future()}
+        batch["texts"].append(text)
+        position = len(batch["texts"])
+        if has_more is None or not has_more():
+            await asyncio.sleep(self.window)
+
+        if (self._pending.get(key) is not batch or len(batch["texts"]) != position
+                or (has_more and has_more())):
+            self.coalesced += 1
+            return batch, None
+        del self._pending[key]
+        self.turns += 1
+        return batch, "\n".join(t for t in batch["texts"] if t)
+
+    @asynccontextmanager
+    async def lock(self, key):
+        if key in self.shared_keys:
+            yield
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def stats(self):
+        return {
+            "turns": self.turns,
+            "coalesced": self.coalesced,
+            "debouncing": len(self._pending),
+            "active_users": len(self._locks),
+        }
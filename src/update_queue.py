@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+# ================== НАСТРОЙКИ ==================
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))  # апдейтов (разных чатов) одновременно
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))     # ждущих апдейтов на все чаты
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "20"))  # секунды на дообработку при остановке
+
+
+def update_key(update):
+    """Чат апдейта (для очередности); если чата нет — пользователь, иначе сам update_id"""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else update.update_id
+
+
+class UpdateQueue:
+    """
+    Очередь апдейтов Телеграма между вебхуком и aiogram.
+    Вебхук кладет апдейт и сразу отвечает 200. У каждого чата своя FIFO-очередь и своя задача,
+    которая разбирает ее по порядку, поэтому апдейты одного чата обрабатываются последовательно,
+    а разные чаты не ждут друг друга. Одновременно обрабатывается не больше concurrency апдейтов.
+    Если всего ждет max_size апдейтов, submit возвращает False — вебхук отвечает 503, и Телеграм повторит доставку.
+    """
+
+    def __init__(self, process, concurrency: int = WEBHOOK_CONCURRENCY, max_size: int = WEBHOOK_QUEUE_SIZE):
+        self.process = process  # async process(update)
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chats = {}   # ключ -> deque[(update, время постановки)] — ждут обработки
+        self._tasks = {}   # ключ -> задача, которая разбирает очередь чата
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._size = 0
+        self._running = False
+        self._closing = False
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, key, update):
+        if self._closing:
+            self.rejected += 1
+            return False
+        if self._size >= self.max_size:
+            self.rejected += 1
+            logging.warning(f"Очередь апдейтов переполнена ({self._size}), просим Телеграм повторить")
+            return False
+        self._chats.setdefault(key, deque()).append((update, time.monotonic()))
+        self._size += 1
+        self.accepted += 1
+        self._idle.clear()
+        if self._running and key not in self._tasks:
+            self._spawn(key)
+        return True
+
+    def backlog(self, key):
+        """Сколько апдейтов этого чата еще ждут своей очереди"""
+        chat = self._chats.get(key)
+        return len(chat) if chat else 0
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            for key in list(self._chats):
+                self._spawn(key)
+
+    async def close(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Перестаем принимать апдейты и даем дообработать очередь"""
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Очередь апдейтов: не успели дообработать {self.qsize()} за {timeout} c")
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running = False
+
+    def qsize(self):
+        return self._size
+
+    def _spawn(self, key):
+        self._tasks[key] = asyncio.create_task(self._drain(key))
+
+    async def _drain(self, key):
+        queue = self._chats[key]
+        try:
+            while queue:
+                async with self._semaphore:
+                    update, enqueued_at = queue.popleft()
+                    self._size -= 1
+                    wait = time.monotonic() - enqueued_at
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    try:
+                        await self.process(update)
+                    except Exception as e:
+                        self.errors += 1
+                        logging.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+                    finally:
+                        self.processed += 1
+        finally:
+            # Между проверкой очереди и этим местом нет await — новый апдейт не потеряется
+            del self._tasks[key]
+            if not queue:
+                del self._chats[key]
+            if not self._tasks:
+                self._idle.set()
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "active_chats": len(self._tasks),
+            "queue_depth": self.qsize(),
+            "max_chat_depth": max((len(chat) for chat in self._chats.values()), default=0),
+            "capacity": self.max_size,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "errors": self.errors,
+            "avg_wait_ms": round(1000 * self.total_wait / self.processed, 1) if self.processed else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait, 1),
+        }
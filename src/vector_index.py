@@ -0,0 +1,65 @@
+import numpy as np
+
+
+class InMemoryVectorIndex:
+    """
+    Точный поиск по базе знаний в памяти.
+    Все векторы коллекции knowledge лежат в одной непрерывной матрице float32, нормированной
+    один раз при загрузке; top-k — одно умножение матрицы на вектор и argpartition.
+    Для нашего объема (одна небольшая коллекция) это быстрее HNSW и без обращений к SQLite.
+    """
+
+    def __init__(self):
+        # (version, ids, documents, matrix) — меняется одной операцией присваивания
+        self._snapshot = None
+
+    @property
+    def ready(self):
+        return self._snapshot is not None
+
+    @property
+    def version(self):
+        return self._snapshot[0] if self._snapshot else None
+
+    def __len__(self):
+        return len(self._snapshot[1]) if self._snapshot else 0
+
+    def load(self, collection, version):
+        """Строит новый снимок и атомарно подменяет старый (запросы в это время идут по старому)"""
+        data = collection.get(include=["embeddings", "documents"])
+        ids = list(data["ids"])
+        documents = list(data["documents"] or [])
+        embeddings = data["embeddings"]
+        if ids:
+            matrix = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix /= norms
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        self._snapshot = (version, ids, documents, matrix)
+        return len(ids)
+
+    def query(self, query_embeddings, n_results: int = 3):
+        """Тот же формат ответа, что у collection.query: ids/documents/distances (косинусное расстояние)"""
+        _, ids, documents, matrix = self._snapshot
+        result = {"ids": [], "documents": [], "distances": []}
+        for vector in query_embeddings:
+            q = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(q)
+            if norm:
+                q = q / norm
+
+            k = min(n_results, len(ids))
+            if k == 0:
+                top = np.array([], dtype=np.int64)
+                scores = np.array([], dtype=np.float32)
+            else:
+                scores = matrix @ q
+                top = np.argpartition(-scores, k - 1)[:k]
+                top = top[np.argsort(-scores[top])]
+
+            result["ids"].append([ids[i] for i in top])
+            result["documents"].append([documents[i] for i in top])
+            result["distances"].append([float(1.0 - scores[i]) for i in top])
+        return result
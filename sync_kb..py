@@ -0,0 +1,45 @@
+"""
+Синхронизация базы знаний (коллекция knowledge в data/) с папкой документов.
+
+    python sync_kb..py --source kb            # Markdown/TXT или экспорт Notion
+    python sync_kb..py --source kb --dry-run  # только показать, что изменится
+
+Пересчитываются только новые и измененные куски, удаленные убираются из Chroma.
+"""
+import os
+import argparse
+import logging
+import chromadb
+from openai import OpenAI
+from dotenv import load_dotenv
+
+from src.knowledge_sync import sync_collection
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальная загрузка базы знаний в ChromaDB")
+    parser.add_argument("--source", default=os.getenv("KB_SOURCE_DIR", "kb"), help="папка с документами")
+    parser.add_argument("--db", default=os.path.join(BASE_DIR, "data"), help="папка ChromaDB")
+    parser.add_argument("--dry-run", action="store_true", help="ничего не записывать")
+    parser.add_argument("--prune-unmanaged", action="store_true",
+                        help="удалить и документы, загруженные не через sync_kb")
+    parser.add_argument("--allow-empty", action="store_true",
+                        help="разрешить синхронизацию с пустой папкой (удалит все документы sync_kb)")
+    args = parser.parse_args()
+
+    db_client = chromadb.PersistentClient(path=args.db)
+    collection = db_client.get_or_create_collection("knowledge")
+
+    stats = sync_collection(collection, lambda: OpenAI(api_key=os.getenv("OPENAI_API_KEY")), args.source,
+                            dry_run=args.dry_run, prune_unmanaged=args.prune_unmanaged,
+                            allow_empty=args.allow_empty)
+    logging.info(f"sync_kb: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,9 +14,12 @@ from aiohttp import web
 import gspread
 from google.oauth2.service_account import Credentials
 from notion_client import Client
+from src.storage import Database
+from src.fsm_storage import PostgresFSMStorage, FSMFlushMiddleware
 
 # ================== КОНФИГУРАЦИЯ ==================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+DATABASE_URL = os.getenv("DATABASE_URL")  # если задан — анкеты хранятся в Postgres
 SPREADSHEET_KEY = os.getenv("MAIN_SHEET_KEY")
 ADMIN_ZHENA_ID = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
 ADMIN_MUZH_ID = int(os.getenv("ADMIN_MUZH_ID", "0"))
@@ -42,7 +45,14 @@ unconfirmed_sheet = spreadsheet.worksheet("leads_unconfirmed")
 
 notion = Client(auth=NOTION_TOKEN)
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+if DATABASE_URL:
+    db = Database(DATABASE_URL)
+    fsm_storage = PostgresFSMStorage(db)
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
+else:
+    db = fsm_storage = None
+    dp = Dispatcher()
 scheduler = AsyncIOScheduler(timezone="Europe/Sofia")
 
 
@@ -451,13 +461,21 @@ async def handle_index(request):
     return web.Response(text="Бот работает!", status=200)
 
 async def on_startup(app):
+    if db is not None:
+        await db.connect()
+        await fsm_storage.init()
     await bot.set_webhook(f"{WEBHOOK_URL}/webhook")
     scheduler.start()
 
+async def on_shutdown(app):
+    if db is not None:
+        await db.close()
+
 app = web.Application()
 app.router.add_post("/webhook", handle_webhook)
 app.router.add_get("/", handle_index)
 app.on_startup.append(on_startup)
+app.on_shutdown.append(on_shutdown)
 
 if __name__ == "__main__":
     web.run_app(app, host="0.0.0.0", port=PORT)
\ No newline at end of file